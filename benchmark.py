@@ -0,0 +1,217 @@
+"""
+Kernel benchmarks for the demos.
+
+    python benchmark.py                               # all demos, default sizes
+    python benchmark.py star_nest nbody --res 640 480 --particles 200 2000
+    python benchmark.py --save bench_baseline.json    # store a baseline
+    python benchmark.py --baseline bench_baseline.json  # flag regressions
+
+Each (demo, resolution, particle count) runs in its own process, because the
+fields of a demo are sized when it is imported. The first launch of every
+kernel is timed separately and reported as compile time, the following
+`--repeat` launches are synchronized with `ti.sync()` and their median is
+reported as ms per launch. The demos run headless, i.e. on `ti.cpu` unless
+the `TI_ARCH` environment variable selects another backend.
+"""
+import argparse
+import importlib
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# For every demo: a function that prepares the module for launching its
+# kernels and the kernels to time. Each kernel is given as
+# (name, launch, work, unit) where `work(W, H, N)` is the amount of work
+# done by one launch, counted in `unit`.
+DEMOS = {
+    'star_nest': (lambda m: m.init(), [
+        ('step', lambda m: m.step(), lambda W, H, N: W * H, 'pixel'),
+        ('render_batch', lambda m: m.render_batch(), lambda W, H, N: W * H * BATCH, 'pixel'),
+    ]),
+    'seascape': (lambda m: m.init(), [
+        ('step', lambda m: m.step(), lambda W, H, N: W * H, 'pixel'),
+    ]),
+    'protean_clouds': (lambda m: m.init(), [
+        ('step', lambda m: m.step(), lambda W, H, N: W * H, 'pixel'),
+    ]),
+    'flame': (lambda m: m.init(), [
+        ('step', lambda m: m.step(), lambda W, H, N: W * H, 'pixel'),
+        ('render_batch', lambda m: m.render_batch(), lambda W, H, N: W * H * BATCH, 'pixel'),
+    ]),
+    'fractal_stamens': (lambda m: None, [
+        ('step', lambda m: m.step(1.0), lambda W, H, N: W * H, 'pixel'),
+        ('render_batch', lambda m: m.render_batch(), lambda W, H, N: W * H * BATCH, 'pixel'),
+    ]),
+    'creative_block': (lambda m: m.init(), [
+        ('renderBuffer', lambda m: m.renderBuffer(), lambda W, H, N: W * H, 'pixel'),
+        ('renderWavefront', lambda m: m.renderWavefront(), lambda W, H, N: W * H, 'pixel'),
+    ]),
+    'nbody': (lambda m: m.init(), [
+        ('compute_force', lambda m: m.compute_force(), lambda W, H, N: N * N, 'pair'),
+        # the approximate solvers do not visit every pair, they are
+        # compared with compute_force by their ms per launch
+        ('barnes_hut', lambda m: (m.build_quadtree(), m.compute_force_barnes_hut()),
+         lambda W, H, N: N, 'particle'),
+        ('pm', lambda m: (m.deposit(), m.solve_mesh(), m.interpolate_force()),
+         lambda W, H, N: N, 'particle'),
+        ('p3m', lambda m: (m.deposit(), m.solve_mesh(), m.interpolate_force(), m.short_range_force()),
+         lambda W, H, N: N, 'particle'),
+        # one frame of the default 10 substeps as separate launches and fused
+        ('simulate', lambda m: m.simulate(), lambda W, H, N: N * N * 10, 'pair'),
+        ('advance', lambda m: m.advance(m.substeps), lambda W, H, N: N * N * 10, 'pair'),
+        ('render', lambda m: m.render(), lambda W, H, N: W * H, 'pixel'),
+        ('render_binned', lambda m: (m.bin_particles(), m.estimate_far_glare(), m.render_binned()),
+         lambda W, H, N: W * H, 'pixel'),
+    ]),
+    'poisson_disk_sampling': (lambda m: (m.refresh_scene(), m.poisson_disk_sample(m.desired_samples)), [
+        ('compute_distance_field', lambda m: m.compute_distance_field(), lambda W, H, N: W * H, 'pixel'),
+    ]),
+}
+
+# Options a demo needs for all of its benchmarked kernels to be available.
+BATCH = 16  # frames per launch of the batched kernels
+DEMO_ARGS = {
+    'creative_block': ['--wavefront'],
+    'star_nest': ['--batch', str(BATCH)],
+    'flame': ['--batch', str(BATCH)],
+    'fractal_stamens': ['--batch', str(BATCH)],
+}
+
+
+def time_kernel(ti, launch, repeat):
+    """Return the duration of the first launch and the median of `repeat`
+    further launches, both in seconds.
+    """
+    t0 = time.perf_counter()
+    launch()
+    ti.sync()
+    first = time.perf_counter() - t0
+
+    durations = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        launch()
+        ti.sync()
+        durations.append(time.perf_counter() - t0)
+    return first, statistics.median(durations)
+
+
+def worker(demo, res, particles, repeat):
+    """Benchmark the kernels of `demo` in this process and print the results
+    as one json list.
+    """
+    argv = [demo, '--headless', '--res', str(res[0]), str(res[1])]
+    if demo == 'nbody':
+        argv += ['--particles', str(particles)]
+    argv += DEMO_ARGS.get(demo, [])
+    sys.argv = argv
+    module = importlib.import_module(demo)
+    import taichi as ti
+
+    setup, kernels = DEMOS[demo]
+    setup(module)
+    ti.sync()
+    results = []
+    for name, launch, work, unit in kernels:
+        first, median = time_kernel(ti, lambda: launch(module), repeat)
+        amount = work(res[0], res[1], particles)
+        results.append({
+            'demo': demo,
+            'kernel': name,
+            'res': list(res),
+            'particles': particles if demo == 'nbody' else None,
+            'compile_s': max(first - median, 0.0),
+            'ms': median * 1e3,
+            'throughput': amount / median / 1e6,
+            'unit': unit,
+        })
+    print(json.dumps(results))
+
+
+def run_worker(demo, res, particles, repeat):
+    cmd = [sys.executable, os.path.abspath(__file__), '--worker', demo,
+           '--res', str(res[0]), str(res[1]), '--particles', str(particles),
+           '--repeat', str(repeat)]
+    env = dict(os.environ, TI_OFFLINE_CACHE='0')  # measure the real compile time
+    out = subprocess.run(cmd, env=env, capture_output=True, text=True,
+                         cwd=os.path.dirname(os.path.abspath(__file__)))
+    if out.returncode != 0:
+        raise RuntimeError(f'benchmark of {demo} failed:\n{out.stderr}')
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def key(record):
+    return '{demo}.{kernel}@{res[0]}x{res[1]}'.format(**record) + (
+        f'/N={record["particles"]}' if record['particles'] is not None else '')
+
+
+def compare(results, baseline, tolerance):
+    """Return the records whose ms per launch exceeds the baseline by more
+    than `tolerance` (relative).
+    """
+    regressions = []
+    for record in results:
+        ref = baseline.get(key(record))
+        if ref is not None and record['ms'] > ref['ms'] * (1 + tolerance):
+            regressions.append((record, ref))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the kernels of the demos.')
+    parser.add_argument('demos', nargs='*', default=list(DEMOS), metavar='demo',
+                        help='demos to benchmark, default: all of ' + ', '.join(DEMOS))
+    parser.add_argument('--res', type=int, nargs='+', default=[256, 256, 512, 512],
+                        help='list of resolutions given as W H pairs')
+    parser.add_argument('--particles', type=int, nargs='+', default=[200, 1000],
+                        help='particle counts of the n-body demo')
+    parser.add_argument('--repeat', type=int, default=10,
+                        help='number of timed launches per kernel')
+    parser.add_argument('--save', metavar='JSON', help='store the results as a baseline')
+    parser.add_argument('--baseline', metavar='JSON', help='compare against a stored baseline')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='relative slowdown reported as a regression')
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        worker(args.worker, tuple(args.res[:2]), args.particles[0], args.repeat)
+        return
+
+    unknown = set(args.demos) - set(DEMOS)
+    if unknown:
+        parser.error('unknown demos: ' + ', '.join(sorted(unknown)))
+    if len(args.res) % 2:
+        parser.error('--res expects W H pairs')
+    resolutions = list(zip(args.res[::2], args.res[1::2]))
+
+    results = []
+    print(f'{"kernel":<56}{"compile s":>10}{"ms":>10}{"throughput":>16}')
+    for demo in args.demos:
+        for res in resolutions:
+            for particles in (args.particles if demo == 'nbody' else [0]):
+                for record in run_worker(demo, res, particles, args.repeat):
+                    results.append(record)
+                    print(f'{key(record):<56}{record["compile_s"]:>10.2f}'
+                          f'{record["ms"]:>10.2f}{record["throughput"]:>10.2f} M{record["unit"]}/s')
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({key(r): r for r in results}, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for record, ref in regressions:
+            print(f'REGRESSION {key(record)}: {record["ms"]:.2f} ms, baseline {ref["ms"]:.2f} ms')
+        if regressions:
+            sys.exit(1)
+        print(f'no regressions against {args.baseline}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,19 @@
+import glob
+import os
 import taichi as ti
 import taichi.math as tm
-from PIL import Image
 import numpy as np
-
-ti.init(arch=ti.vulkan)
+import headless
+import recorder
+import texture
+import tiles
+
+args = headless.parse_args('Creative Block', res=(800, 450), adaptive=False,
+                           noise_threshold=0.01, min_samples=16, wavefront=False,
+                           seed=0, checkpoint='', checkpoint_every=100, merge='',
+                           relax=1.0, step_stats=False, packed=False,
+                           tile=0, tile_worker='0/1')
+ti.init(arch=ti.cpu if args.headless else ti.vulkan, random_seed=args.seed)
 
 kMatGround = 0
 kMatPlasticRed = 1
@@ -12,21 +22,73 @@ kMatLead = 3
 IOR = 1.584
 flip = 1.0
 
-W, H = 800, 450
+# Away from the pencil the scene is the ground and a bound of the pencil:
+# the cylinder around its axis cut at the tip. Only closer than
+# kBoundMargin to that bound the detailed SDF and its textures are used.
+kPencilRadius = 5.0
+kPencilTip = 0.5
+kBoundMargin = 1.0
+
+# Over-relaxed sphere tracing steps `relax` times the distance and falls
+# back to the plain step when the unbounding spheres stop overlapping.
+# Rays beyond kFar are sky, relaxed steps would otherwise grow to inf.
+relax = args.relax
+kFar = 1e4
+
+W, H = args.res
 iResolution = tm.vec2(W, H)
-texture_res = tm.ivec2(64, 64)
-material = ti.Vector.field(2, int, shape=(W, H))
-iChannel0 = ti.Vector.field(4, float, shape=(W, H))
-iChannel1 = ti.Vector.field(4, float, shape=texture_res)
-img = ti.Vector.field(4, float, shape=(W, H))
 
+# Tiled mode accumulates and saves the image in tiles of TW x TH pixels,
+# the pixel (i, j) of the per pixel fields is the pixel (i, j) + origin of
+# the image, see tiles.py.
+tiled = args.tile > 0 and args.headless
+TW, TH = (args.tile, args.tile) if tiled else (W, H)
+origin = ti.Vector.field(2, int, shape=())
 
-def load_texture(texture, image_file):
-    """Load a background image to a Taichi field.
-    """
-    img = Image.open(image_file).resize(texture_res).convert("RGBA")
-    data = np.asarray(img).astype(np.float32) / 255.0
-    texture.from_numpy(data)
+texture_res = (64, 64)
+material = ti.Vector.field(2, int, shape=(TW, TH))
+iChannel0 = ti.Vector.field(4, float, shape=(TW, TH))
+iChannel1 = ti.Vector.field(4, float, shape=texture_res)
+iChannel1.from_numpy(texture.load(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                               'noise_gray_64x64.png'), texture_res))
+img = recorder.image((TW, TH), 4, args.packed)
+
+# Adaptive sampling: the second moment of each pixel's luminance gives the
+# standard error of its mean, pixels keep sampling until that error, seen
+# through the tone curve of renderImage, drops below noise_threshold.
+adaptive = args.adaptive
+noise_threshold = args.noise_threshold
+min_samples = args.min_samples
+moment2 = ti.field(float, shape=(TW, TH))  # sum of squared sample luminances
+active = ti.Vector.field(2, int, shape=TW * TH)  # pixels still sampled
+active_count = ti.field(int, shape=())
+
+# Wavefront mode: one path per sampled pixel lives in the path buffers,
+# each bounce intersects all live paths in one kernel and shades them in
+# one kernel per material over compacted queues.
+wavefront = args.wavefront
+num_paths = TW * TH if wavefront else 1
+path_pixel = ti.Vector.field(2, int, shape=num_paths)
+path_cam = ti.Vector.field(3, float, shape=num_paths)  # ray origin
+path_dir = ti.Vector.field(3, float, shape=num_paths)
+path_accum = ti.Vector.field(3, float, shape=num_paths)  # path throughput
+path_hit = ti.Vector.field(3, float, shape=num_paths)
+path_normal = ti.Vector.field(3, float, shape=num_paths)
+live = ti.field(int, shape=(2, num_paths))  # live paths of this and the next bounce
+live_count = ti.field(int, shape=2)
+shade_queue = ti.field(int, shape=(4, num_paths))  # hit paths per material
+shade_count = ti.field(int, shape=4)
+
+# Scene evaluations per pixel, in total and of the detailed SDF.
+step_stats = args.step_stats
+scene_calls = ti.field(int, shape=(TW, TH) if step_stats else 1)
+scene_detail = ti.field(int, shape=(TW, TH) if step_stats else 1)
+
+# Checkpoints store the accumulation state as a (W, H, 6) float32 .npy:
+# summed rgb, sample count, summed squared luminance and the texture flag
+# material[1]. Workers started with different --seed values accumulate
+# independent samples of the same image, --merge sums their checkpoints.
+kCheckpointChannels = 6
 
 
 @ti.kernel
@@ -40,24 +102,11 @@ def init():
 
     for i, j in iChannel0:
         iChannel0[i, j] = 0, 0, 0, 0
+        moment2[i, j] = 0
 
-    for i, j in iChannel1:
-        iChannel1[i, j] = tm.vec4(ti.random())
-
-
-@ti.func
-def texture(tex, uv):
-    p = tm.mod(uv * texture_res, texture_res)
-    ip = int(p)
-    fp = p - ip
-    i0, j0 = ip
-    i1 = min(texture_res.x, i0 + 1)
-    j1 = min(texture_res.y, j0 + 1)
-    a = tex[i0, j0]
-    b = tex[i1, j0]
-    c = tex[i0, j1]
-    d = tex[i1, j1]
-    return tm.mix(tm.mix(a, b, fp.x), tm.mix(c, d, fp.x), fp.y)
+    for I in ti.grouped(scene_calls):
+        scene_calls[I] = 0
+        scene_detail[I] = 0
 
 
 @ti.func
@@ -100,42 +149,53 @@ def sdCone(p, c):
 
 
 @ti.func
-def scene(p, fragCoord):
+def sceneMaterial(p, fragCoord):
     ground = p.y - (tm.cos(min(100, p.z) * 0.03) - 1) * 2
     p.y -= 4
     p.xz = tm.rot2(2.1) @ p.xz
     p.z -= 10
-    a = 0.23
-    cone = sdCone(p.xzy, tm.vec2(tm.sin(a), tm.cos(a)))
-    paintShell = hexa(p.xy, 4, 1)
-    woodCenter = hexa(p.xy, 3.95, 0.95)
-    leadCore = tm.length(p.xy) - 1.1
-
-    paintShell = max(paintShell, max(cone, -woodCenter))
-    woodCenter = max(woodCenter, cone)
-
-    woodCenter = max(woodCenter, 0.01 - leadCore)
-    if material[fragCoord][1]:
-        woodCenter += (texture(iChannel1, p.xy * 0.25).r - 0.4) * 0.1
-    leadCore = max(leadCore, cone)
-    leadCore = max(leadCore, p.z + 1)
-    leadCore = min(leadCore, tm.length(p + tm.vec3(0,0,1.05)) - tm.sin(a))
-    leadCore += (texture(iChannel1, tm.vec2(tm.atan2(p.x, p.z) * 0.5)).r - 0.3) * 0.05
+    if ti.static(step_stats):
+        scene_calls[fragCoord] += 1
 
     best = ground
-    best = min(best, paintShell)
-    best = min(best, woodCenter)
-    best = min(best, leadCore)
-
-    if best == ground:
-        material[fragCoord][0] = kMatGround
-    elif best == leadCore:
-        material[fragCoord][0] = kMatLead
-    elif best == woodCenter:
-        material[fragCoord][0] = kMatWood
-    elif best == paintShell:
-        material[fragCoord][0] = kMatPlasticRed
-    return best
+    mat = kMatGround
+    bound = max(tm.length(p.xy) - kPencilRadius, p.z - kPencilTip)
+    if bound > kBoundMargin:
+        best = min(ground, bound)
+    else:
+        if ti.static(step_stats):
+            scene_detail[fragCoord] += 1
+        a = 0.23
+        cone = sdCone(p.xzy, tm.vec2(tm.sin(a), tm.cos(a)))
+        paintShell = hexa(p.xy, 4, 1)
+        woodCenter = hexa(p.xy, 3.95, 0.95)
+        leadCore = tm.length(p.xy) - 1.1
+
+        paintShell = max(paintShell, max(cone, -woodCenter))
+        woodCenter = max(woodCenter, cone)
+
+        woodCenter = max(woodCenter, 0.01 - leadCore)
+        if material[fragCoord][1]:
+            woodCenter += (texture.sample(iChannel1, p.xy * 0.25, True).r - 0.4) * 0.1
+        leadCore = max(leadCore, cone)
+        leadCore = max(leadCore, p.z + 1)
+        leadCore = min(leadCore, tm.length(p + tm.vec3(0,0,1.05)) - tm.sin(a))
+        leadCore += (texture.sample(iChannel1, tm.vec2(tm.atan2(p.x, p.z) * 0.5), True).r - 0.3) * 0.05
+
+        best = min(best, paintShell)
+        best = min(best, woodCenter)
+        best = min(best, leadCore)
+
+        mat = material[fragCoord][0]
+        if best == ground:
+            mat = kMatGround
+        elif best == leadCore:
+            mat = kMatLead
+        elif best == woodCenter:
+            mat = kMatWood
+        elif best == paintShell:
+            mat = kMatPlasticRed
+    return best, mat
 
 
 @ti.func
@@ -175,28 +235,68 @@ def sky(sunDir, viewDir):
 
 
 @ti.func
-def trace5(cam, dir, nearClip, h: ti.template(), n: ti.template(), k: ti.template(), fragCoord):
+def march(cam, dir, nearClip, fragCoord):
+    # the material needs to be known at the hit only, marching does not
+    # write it
     t = nearClip
+    k = 0.0
+    omega = relax
+    step = 0.0
+    prev = 0.0
     for _ in range(100):
-        k = scene(cam + dir * t, fragCoord) * flip
-        if abs(k) < 0.001:
-            break
-        t += k
+        k = sceneMaterial(cam + dir * t, fragCoord)[0] * flip
+        if omega > 1.0 and abs(k) + prev < step:
+            # overshot, redo the last step unrelaxed
+            t -= step - step / omega
+            step /= omega
+            omega = 1.0
+        else:
+            if abs(k) < 0.001 or t > kFar:
+                break
+            prev = abs(k)
+            step = k * omega
+            t += step
+    return t, k
+
 
+@ti.func
+def trace5(cam, dir, nearClip, h: ti.template(), n: ti.template(), k: ti.template(), fragCoord):
+    t, k = march(cam, dir, nearClip, fragCoord)
     h = cam + dir * t
 
     result = False
     if abs(k) < 0.001:
         o = tm.vec2(.001, 0)
+        dz, mat = sceneMaterial(h + o.yyx, fragCoord)
+        material[fragCoord][0] = mat
         n = tm.normalize(tm.vec3(
-            scene(h + o.xyy, fragCoord) - k,
-            scene(h + o.yxy, fragCoord) - k,
-            scene(h + o.yyx, fragCoord) - k
+            sceneMaterial(h + o.xyy, fragCoord)[0] - k,
+            sceneMaterial(h + o.yxy, fragCoord)[0] - k,
+            dz - k
         )) * flip
         result = True
     return result
 
 
+@ti.func
+def traceHit(cam, dir, nearClip, fragCoord):
+    # trace5 without writing the material, the material of a hit is the
+    # one of its last normal tap like in trace5
+    t, k = march(cam, dir, nearClip, fragCoord)
+    h = cam + dir * t
+    n = tm.vec3(0)
+    mat = -1
+    if abs(k) < 0.001:
+        o = tm.vec2(.001, 0)
+        dz, mat = sceneMaterial(h + o.yyx, fragCoord)
+        n = tm.normalize(tm.vec3(
+            sceneMaterial(h + o.xyy, fragCoord)[0] - k,
+            sceneMaterial(h + o.yxy, fragCoord)[0] - k,
+            dz - k
+        )) * flip
+    return h, n, mat
+
+
 @ti.func
 def floorPattern(uv):
     kUnit1 = 10.0
@@ -276,45 +376,251 @@ def bokeh():
     return a
 
 
+@ti.func
+def pixel(i, j):
+    # the image coordinates of pixel (i, j) of the per pixel fields, formed
+    # in integers, fast math would otherwise reassociate the offset
+    p = tm.vec2(i, j)
+    if ti.static(tiled):
+        p = float(tm.ivec2(i, j) + origin[None])
+    return p
+
+
+@ti.func
+def cameraRay(i, j):
+    uv = (pixel(i, j) + hash2() - 0.5) / iResolution - 0.5
+    aspect = iResolution.x / iResolution.y
+    uv.x *= aspect
+    uv *= max(1, (16 / 9) / aspect)
+    camPos = tm.vec3(140, 60, 60) * 1.5
+    lookAt = tm.vec3(0, 4, 0)
+    focusDistance = tm.distance(camPos, lookAt) * 0.99
+    apertureRadius = tm.vec2(3)
+    cam = tm.vec3(0)
+    dir = tm.normalize(tm.vec3(uv, 6.5))
+    bokehJitter = bokeh()
+    cam.xy += bokehJitter * apertureRadius
+    dir.xy -= bokehJitter * apertureRadius * dir.z / focusDistance
+
+    lookDir = lookAt - camPos
+    pitch = -tm.atan2(lookDir.y, tm.length(lookDir.xz))
+    yaw = -tm.atan2(lookDir.x, lookDir.z)
+    cam.yz = tm.rot2(pitch) @ cam.yz
+    dir.yz = tm.rot2(pitch) @ dir.yz
+    cam.xz = tm.rot2(yaw) @ cam.xz
+    dir.xz = tm.rot2(yaw) @ dir.xz
+    cam += camPos
+    return cam, dir
+
+
+@ti.func
+def addSample(i, j, pixel):
+    if pixel.x >= 0.0:
+        iChannel0[i, j] += tm.vec4(pixel, 1)
+        moment2[i, j] += tm.dot(pixel, tm.vec3(0.2126, 0.7152, 0.0722)) ** 2
+
+
+@ti.func
+def renderSample(i, j):
+    cam, dir = cameraRay(i, j)
+    nearClip = tm.length(tm.vec3(140, 60, 60) * 1.5) * 0.7
+    addSample(i, j, trace2(cam, dir, nearClip, tm.ivec2(i, j)))
+
+
 @ti.kernel
 def renderBuffer():
     for i, j in iChannel0:
-        fragCoord = tm.ivec2(i, j)
-        fragColor = iChannel0[fragCoord]
-        uv = (tm.vec2(i, j) + hash2() - 0.5) / iResolution - 0.5
-        aspect = iResolution.x / iResolution.y
-        uv.x *= aspect
-        uv *= max(1, (16 / 9) / aspect)
-        camPos = tm.vec3(140, 60, 60) * 1.5
-        lookAt = tm.vec3(0, 4, 0)
-        focusDistance = tm.distance(camPos, lookAt) * 0.99
-        apertureRadius = tm.vec2(3)
-        cam = tm.vec3(0)
-        dir = tm.normalize(tm.vec3(uv, 6.5))
-        bokehJitter = bokeh()
-        cam.xy += bokehJitter * apertureRadius
-        dir.xy -= bokehJitter * apertureRadius * dir.z / focusDistance
-
-        lookDir = lookAt - camPos
-        pitch = -tm.atan2(lookDir.y, tm.length(lookDir.xz))
-        yaw = -tm.atan2(lookDir.x, lookDir.z)
-        cam.yz = tm.rot2(pitch) @ cam.yz
-        dir.yz = tm.rot2(pitch) @ dir.yz
-        cam.xz = tm.rot2(yaw) @ cam.xz
-        dir.xz = tm.rot2(yaw) @ dir.xz
-        cam += camPos
-        pixel = trace2(cam, dir, tm.length(camPos) * 0.7, fragCoord)
-        if pixel.x >= 0.0:
-            fragColor += tm.vec4(pixel, 1)
+        renderSample(i, j)
+
+
+@ti.kernel
+def renderActive():
+    for k in range(active_count[None]):
+        renderSample(active[k].x, active[k].y)
+
+
+@ti.kernel
+def updateActive() -> int:
+    active_count[None] = 0
+    for i, j in iChannel0:
+        n = iChannel0[i, j].a
+        lum = tm.dot(iChannel0[i, j].rgb, tm.vec3(0.2126, 0.7152, 0.0722)) / max(n, 1)
+        var = max(moment2[i, j] / max(n, 1) - lum * lum, 0)
+        # the tone curve is close to (3.5 * lum)^0.45, its slope converts
+        # the standard error of the mean to displayed units
+        err = 0.45 * 3.5**0.45 * tm.sqrt(var / max(n, 1)) / max(lum, 1e-4) ** 0.55
+        if n < min_samples or err > noise_threshold:
+            active[ti.atomic_add(active_count[None], 1)] = tm.ivec2(i, j)
+    return active_count[None]
+
+
+@ti.kernel
+def generatePaths(fromActive: int) -> int:
+    n = active_count[None] if fromActive else TW * TH
+    for k in range(n):
+        pixel = active[k] if fromActive else tm.ivec2(k // TH, k % TH)
+        path_pixel[k] = pixel
+        path_cam[k], path_dir[k] = cameraRay(pixel.x, pixel.y)
+        path_accum[k] = tm.vec3(1)
+        live[0, k] = k
+    live_count[0] = n
+    return n
+
+
+@ti.kernel
+def intersectPaths(bounce: int, src: int):
+    sunDirection = tm.normalize(tm.vec3(-1., .8, -.7))
+    nearClip = tm.length(tm.vec3(140, 60, 60) * 1.5) * 0.7 if bounce == 0 else 0.0
+    for q in range(4):
+        shade_count[q] = 0
+    for k in range(live_count[src]):
+        p = live[src, k]
+        h, n, mat = traceHit(path_cam[p], path_dir[p], nearClip, path_pixel[p])
+        if mat >= 0:
+            path_hit[p] = h
+            path_normal[p] = n
+            shade_queue[mat, ti.atomic_add(shade_count[mat], 1)] = p
+        else:
+            # missed, the path ends in the sky
+            addSample(path_pixel[p].x, path_pixel[p].y, sky(sunDirection, path_dir[p]) * path_accum[p])
+
+
+@ti.kernel
+def shadePaths(mat: ti.template(), bounce: int, dst: int):
+    for k in range(shade_count[mat]):
+        p = shade_queue[mat, k]
+        dir, n, h = path_dir[p], path_normal[p], path_hit[p]
+        accum = path_accum[p]
+        path_cam[p] = h + n * 0.01
+        if ti.static(mat == kMatGround):
+            dir = getSampleBiased(n, 1)
+            accum *= tm.mix(tm.vec3(.25, .3, .35), tm.vec3(.8), tm.step(0, floorPattern(h.xz)))
+            if bounce == 0:
+                material[path_pixel[p]][1] = 0
+        elif ti.static(mat == kMatWood):
+            dir = getSampleBiased(n, 1)
+            col = tm.vec3(211, 183, 155) / 255
+            accum *= col * col * col
+        elif ti.static(mat == kMatPlasticRed):
+            fresnel = tm.pow(1 - min(.99, tm.dot(-dir, n)), 5)
+            fresnel = tm.mix(.04, 1., fresnel)
+            if ti.random() < fresnel:
+                dir = tm.reflect(dir, n)
+            else:
+                dir = getSampleBiased(n, 1)
+                accum *= tm.vec3(180, 2, 1) / 255.
         else:
-            fragColor += tm.vec4(0)
-        iChannel0[i, j] = fragColor
+            dir = getConeSample(tm.reflect(dir, n), 0.3)
+            accum *= .05
+        path_dir[p] = dir
+        path_accum[p] = accum
+        live[dst, ti.atomic_add(live_count[dst], 1)] = p
+
+
+@ti.kernel
+def finishPaths(src: int):
+    sunDirection = tm.normalize(tm.vec3(-1., .8, -.7))
+    for k in range(live_count[src]):
+        p = live[src, k]
+        addSample(path_pixel[p].x, path_pixel[p].y, sky(sunDirection, path_dir[p]) * path_accum[p])
+
+
+def renderWavefront(fromActive=False):
+    """The wavefront version of renderBuffer (renderActive), returns the
+    number of pixels sampled."""
+    n = generatePaths(fromActive)
+    src = 0
+    for bounce in range(10):
+        intersectPaths(bounce, src)
+        live_count[1 - src] = 0
+        for mat in (kMatGround, kMatWood, kMatPlasticRed, kMatLead):
+            shadePaths(mat, bounce, 1 - src)
+        src = 1 - src
+        if live_count[src] == 0:
+            break
+    finishPaths(src)
+    return n
+
+
+def accumulate():
+    """Add one sample to every pixel, or in adaptive mode to every pixel that
+    has not converged yet. Returns the number of pixels sampled.
+    """
+    if not adaptive:
+        if wavefront:
+            return renderWavefront()
+        renderBuffer()
+        return TW * TH
+
+    count = updateActive()
+    if count > 0:
+        if wavefront:
+            renderWavefront(True)
+        else:
+            renderActive()
+    return count
+
+
+def get_state():
+    state = np.empty((W, H, kCheckpointChannels), np.float32)
+    state[..., :4] = iChannel0.to_numpy()
+    state[..., 4] = moment2.to_numpy()
+    state[..., 5] = material.to_numpy()[..., 1]
+    return state
+
+
+def set_state(state):
+    if state.shape != (W, H, kCheckpointChannels):
+        raise ValueError(f'checkpoint of shape {state.shape} does not match the resolution {W}x{H}')
+    iChannel0.from_numpy(np.ascontiguousarray(state[..., :4]))
+    moment2.from_numpy(np.ascontiguousarray(state[..., 4]))
+    mat = material.to_numpy()
+    mat[..., 1] = state[..., 5]
+    material.from_numpy(mat)
+
+
+def save_checkpoint(path):
+    """Write the accumulation state to the .npy file `path`. The state is
+    written to a temporary file first, an interrupted write never destroys
+    the previous checkpoint. The temporary name does not end in .npy, so
+    one left behind by a killed worker is not picked up by `--merge`.
+    """
+    tmp = path + '.tmp'
+    out = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.float32,
+                                    shape=(W, H, kCheckpointChannels))
+    out[:] = get_state()
+    out.flush()
+    del out
+    os.replace(tmp, path)
+
+
+def load_checkpoint(path):
+    set_state(np.load(path, mmap_mode='r'))
+
+
+def merge_checkpoints(paths):
+    """Sum the checkpoints of independent workers into the accumulation
+    state, a pixel shows the wood texture only if it does in all of them.
+    """
+    total = None
+    for path in paths:
+        state = np.load(path, mmap_mode='r')
+        if total is None:
+            total = np.array(state)
+        else:
+            if state.shape != total.shape:
+                raise ValueError(f'{path} has shape {state.shape}, expected {total.shape}')
+            total[..., :5] += state[..., :5]
+            total[..., 5] = np.minimum(total[..., 5], state[..., 5])
+    if total is None:
+        raise ValueError('no checkpoints to merge')
+    set_state(total)
 
 
 @ti.kernel
 def renderImage():
     for i, j in img:
-        uv = tm.vec2(i, j) /iResolution
+        uv = pixel(i, j) /iResolution
         tex = iChannel0[tm.ivec2(i, j)]
         color = tex.rgb / tex.a
         uv -= 0.5
@@ -329,29 +635,102 @@ def renderImage():
         uv *= iResolution.xy / iResolution.yx
         color *= tm.step(abs(uv.y), 0.5 / (16 / 9))
         color *= tm.step(abs(uv.x), 0.5 * (16 / 9))
-        img[i, j] = tm.vec4(color, 1)
+        recorder.store(img, i, j, tm.vec4(color, 1))
 
 
+def render_offline():
+    """Accumulate up to `args.frames` samples per pixel and save the final
+    image, in adaptive mode the rendering stops once all pixels converged.
+
+    With `--checkpoint` the accumulation resumes from that file if it exists
+    and is written back every `--checkpoint-every` passes and at the end.
+    With `--merge` the checkpoints matching the glob pattern are summed and
+    the merged image is saved instead. With `--tile` every tile accumulates
+    its samples and is saved in turn.
+    """
+    if tiled:
+        if args.checkpoint or args.merge:
+            raise SystemExit('--tile does not support --checkpoint and --merge')
+
+        def render_tile():
+            init()
+            for frame in range(args.frames):
+                if accumulate() == 0:
+                    break
+            renderImage()
+
+        tiles.render(args, 'creative_block', origin, render_tile, img)
+        return
+
+    init()
+    if args.merge:
+        paths = sorted(glob.glob(args.merge))
+        merge_checkpoints(paths)
+        print(f'merged {len(paths)} checkpoints, {iChannel0.to_numpy()[..., 3].mean():.1f} samples per pixel')
+        if args.checkpoint:
+            save_checkpoint(args.checkpoint)
+        renderImage()
+        headless.save(img, args, 'creative_block.png')
+        return
+
+    if args.checkpoint and os.path.exists(args.checkpoint):
+        load_checkpoint(args.checkpoint)
+        print(f'resumed from {args.checkpoint}, {iChannel0.to_numpy()[..., 3].mean():.1f} samples per pixel')
+
+    total = 0
+    for frame in range(args.frames):
+        count = accumulate()
+        total += count
+        if count == 0:
+            print(f'converged after {frame} passes, {total / (W * H):.1f} samples per pixel')
+            break
+        if args.checkpoint and (frame + 1) % args.checkpoint_every == 0:
+            save_checkpoint(args.checkpoint)
+    if args.checkpoint:
+        save_checkpoint(args.checkpoint)
+    if step_stats:
+        calls = scene_calls.to_numpy().sum()
+        print(f'{calls / max(total, 1):.1f} SDF evaluations per sample, '
+              f'{scene_detail.to_numpy().sum() / max(calls, 1):.1%} of them detailed')
+    renderImage()
+    headless.save(img, args, 'creative_block.png')
+
 
 def main():
     gui = ti.ui.Window('Creative Block', res=(W, H))
     canvas = gui.get_canvas()
     init()
-    #load_texture(iChannel1, "./noise_gray_64x64.png")
+    if args.checkpoint and os.path.exists(args.checkpoint):
+        load_checkpoint(args.checkpoint)
+    converged = False
+    passes = 0
+    rec = None
     while gui.running:
-        gui.get_event(ti.ui.PRESS)
+        if gui.get_event(ti.ui.PRESS) and gui.event.key == 'p':
+            rec = recorder.toggle(rec, args, 'creative_block')
         if gui.is_pressed(ti.ui.ESCAPE):
             gui.running = False
 
-        if gui.is_pressed('p'):
-            canvas.set_image(img)
-            gui.write_image('screenshot.png')
-
-        renderBuffer()
+        if accumulate() == 0 and not converged:
+            converged = True
+            print('converged')
+        passes += 1
+        if args.checkpoint and passes % args.checkpoint_every == 0:
+            save_checkpoint(args.checkpoint)
         renderImage()
+        if rec is not None:
+            rec.push(img)
         canvas.set_image(img)
         gui.show()
 
+    if rec is not None:
+        rec.close()
+    if args.checkpoint:
+        save_checkpoint(args.checkpoint)
+
 
 if __name__ == '__main__':
-    main()
+    if args.headless:
+        render_offline()
+    else:
+        main()
@@ -2,15 +2,27 @@
 import time
 import taichi as ti
 import taichi.math as tm
+import governor
+import headless
+import recorder
 
-ti.init(arch=ti.vulkan)
+args = headless.parse_args('Flame', res=(800, 640), target_fps=0.0, packed=False,
+                           batch=0)
+ti.init(arch=ti.cpu if args.headless else ti.vulkan)
 
-W, H = 800, 640
+W, H = args.res
 iResolution = tm.vec2(W, H)
 iTime = ti.field(float, shape=())
 iMouse = ti.Vector.field(2, float, shape=())
 
-img = ti.Vector.field(4, float, shape=(W, H))
+img = recorder.image((W, H), 4, args.packed)
+
+# frames rendered by one launch of render_batch
+batch, frame_time, frames = headless.batch_fields(args, 4)
+
+MARCH_STEPS = 64
+march_budget = ti.field(int, shape=())  # at most MARCH_STEPS
+gov = governor.Governor(args.target_fps, {'march steps': (march_budget, 16, MARCH_STEPS)})
 
 
 def init():
@@ -35,55 +47,82 @@ def sphere(p, spr):
 
 
 @ti.func
-def flame(p):
+def flame(p, t):
     d = sphere(p * tm.vec3(1, 0.5, 1.0), tm.vec4(.0,-1.,.0,1.))
-    return d + (noise(p + tm.vec3(.0, iTime[None] * 2, 0)) + noise(p * 3) * 0.5) * 0.25 * (p.y)
+    return d + (noise(p + tm.vec3(.0, t * 2, 0)) + noise(p * 3) * 0.5) * 0.25 * (p.y)
 
 
 @ti.func
-def scene(p):
-    return tm.min(100 - tm.length(p), abs(flame(p)))
+def scene(p, t):
+    return tm.min(100 - tm.length(p), abs(flame(p, t)))
 
 
 @ti.func
-def raymarch(org, dir):
+def raymarch(org, dir, t):
     glow = 0.0
     eps = 0.02
     p = org
     glowed = False
-    for i in range(64):
-        d = scene(p) + eps
+    n = march_budget[None]
+    for i in range(n):
+        d = scene(p, t) + eps
         p += d * dir
         if d > eps:
-            if flame(p) < 0:
+            if flame(p, t) < 0:
                 glowed = True
             if glowed:
-                glow = float(i) / 64
+                glow = float(i) / n
     return tm.vec4(p, glow)
 
 
+@ti.func
+def shade(i, j, t):
+    v = 2 * tm.vec2(i, j) / iResolution - 1
+    v.x *= W / H
+    org = tm.vec3(0., -2., 4.)
+    dir = tm.normalize(tm.vec3(v.x*1.6, -v.y, -1.5))
+    p = raymarch(org, dir, t)
+    glow = p.w
+    col = tm.mix(tm.vec4(1, 0.5, 0.1, 1),
+                 tm.vec4(0.1, 0.5, 1, 1),
+                 p.y * 0.02 + 0.4)
+    return tm.mix(tm.vec4(0), col, tm.pow(glow * 2, 4))
+
+
 @ti.kernel
 def step():
     for i, j in img:
-        v = 2 * tm.vec2(i, j) / iResolution - 1
-        v.x *= W / H
-        org = tm.vec3(0., -2., 4.)
-        dir = tm.normalize(tm.vec3(v.x*1.6, -v.y, -1.5))
-        p = raymarch(org, dir)
-        glow = p.w
-        col = tm.mix(tm.vec4(1, 0.5, 0.1, 1),
-                     tm.vec4(0.1, 0.5, 1, 1),
-                     p.y * 0.02 + 0.4)
-        col = tm.mix(tm.vec4(0), col, tm.pow(glow * 2, 4))
-        img[i, j] = col
+        recorder.store(img, i, j, shade(i, j, iTime[None]))
+
+
+@ti.kernel
+def render_batch():
+    for f, i, j in frames:
+        frames[f, i, j] = recorder.encode(frames, shade(i, j, frame_time[f]))
+
+
+def render_offline():
+    init()
+    if batch:
+        headless.run_batch(args, 'flame', render_batch, frame_time, frames)
+        return
+
+    def advance(t):
+        iTime[None] = t
+        gov(step)
+
+    headless.run(args, 'flame', advance, img)
+    gov.report()
 
 
 def main():
     t0 = init()
     gui = ti.ui.Window('Flame', res=(W, H))
     canvas = gui.get_canvas()
+    rec = None
     while gui.running:
-        gui.get_event(ti.ui.PRESS)
+        if gui.get_event(ti.ui.PRESS) and gui.event.key == 'p':
+            rec = recorder.toggle(rec, args, 'flame')
         if gui.is_pressed(ti.ui.LMB):
             mouse_x, mouse_y = gui.get_cursor_pos()
             iMouse[None] = tm.vec2(mouse_x, mouse_y) * iResolution
@@ -91,15 +130,19 @@ def main():
         if gui.is_pressed(ti.ui.ESCAPE):
             gui.running = False
 
-        if gui.is_pressed('p'):
-            canvas.set_image(img)
-            gui.show('screenshot.png')
-
-        step()
+        gov(step)
+        if rec is not None:
+            rec.push(img)
         iTime[None] = time.perf_counter() - t0
         canvas.set_image(img)
         gui.show()
 
+    if rec is not None:
+        rec.close()
+
 
 if __name__ == '__main__':
-    main()
+    if args.headless:
+        render_offline()
+    else:
+        main()
@@ -0,0 +1,48 @@
+"""
+Frame time governor shared by the demos.
+
+The loop budgets of a demo, e.g. its ray marching steps or fractal
+iterations, are 0-d int fields read by its kernels. A `Governor` times
+every frame and scales all budgets by one quality factor to hold the
+target frame rate. The compile time constants of the demo are the maximum
+budgets, so the governor only trades quality for speed.
+"""
+import time
+import taichi as ti
+
+
+class Governor:
+    def __init__(self, target_fps, budgets, gain=0.5):
+        """`budgets` maps a name to (field, minimum, maximum), all budgets
+        start at their maximum. A `target_fps` of 0 disables the governor.
+        """
+        self.target = 1 / target_fps if target_fps > 0 else None
+        self.budgets = budgets
+        self.gain = gain
+        self.floor = min(lo / hi for _, lo, hi in budgets.values())
+        self.quality = 1.0
+        for field, _, hi in budgets.values():
+            field[None] = hi
+
+    def __call__(self, step, *args):
+        """Run `step(*args)` and adapt the budgets to its duration.
+        """
+        t0 = time.perf_counter()
+        step(*args)
+        if self.target is None:
+            return
+        ti.sync()
+        self.update(time.perf_counter() - t0)
+
+    def update(self, elapsed):
+        # the cost of a frame grows with the budgets, a damped
+        # multiplicative step converges for linear and quadratic costs
+        ratio = self.target / max(elapsed, 1e-6)
+        self.quality = min(1.0, max(self.floor, self.quality * ratio**self.gain))
+        for field, lo, hi in self.budgets.values():
+            field[None] = max(lo, round(hi * self.quality))
+
+    def report(self):
+        if self.target is not None:
+            budgets = ', '.join(f'{name} {field[None]}' for name, (field, _, _) in self.budgets.items())
+            print(f'quality {self.quality:.2f} for {1 / self.target:.1f} fps: {budgets}')
@@ -0,0 +1,119 @@
+"""
+Command line options and offline render loop shared by the demos.
+
+Every demo accepts the same set of options, for example
+
+    python star_nest.py --headless --res 1920 1080 --frames 120 --outdir frames
+
+renders 120 frames on the CPU backend without opening a window, advancing the
+animation by a fixed time step `--dt` per frame, and writes them to `frames/`
+as numbered PNG files, or with `--format y4m` as one raw video stream. The
+frames are encoded by a background thread while the next ones render. Without
+`--headless` the demo opens its window as usual and the `p` key starts and
+stops a recording to `--outdir` in the same format.
+"""
+import argparse
+import os
+import time
+import numpy as np
+import taichi as ti
+import recorder
+
+
+def parse_args(description, res, **extra):
+    """Parse the shared options, `res` is the default window resolution.
+
+    Each keyword in `extra` adds a demo specific option `--name` whose type
+    is taken from its default value, boolean options are switched on by
+    their flag.
+    """
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--headless', action='store_true',
+                        help='render to image files on the CPU backend without a window')
+    parser.add_argument('--res', type=int, nargs=2, default=res, metavar=('W', 'H'),
+                        help='output resolution')
+    parser.add_argument('--frames', type=int, default=60,
+                        help='number of frames to render in headless mode')
+    parser.add_argument('--dt', type=float, default=1 / 60,
+                        help='fixed time step between two frames in headless mode')
+    parser.add_argument('--outdir', default='frames',
+                        help='output directory of the headless mode and of recordings')
+    parser.add_argument('--format', choices=recorder.FORMATS, default='png',
+                        help='numbered PNG files or one raw Y4M video stream')
+    parser.add_argument('--queue', type=int, default=2,
+                        help='frames read back but not yet written before rendering waits')
+    for name, default in extra.items():
+        flag = '--' + name.replace('_', '-')
+        if isinstance(default, bool):
+            parser.add_argument(flag, action='store_true', default=default)
+        else:
+            parser.add_argument(flag, type=type(default), default=default)
+
+    args = parser.parse_args()
+    if args.format == 'y4m' and args.dt <= 0:
+        parser.error('--format y4m needs a positive --dt')
+    args.res = tuple(args.res)
+    return args
+
+
+def save(img, args, filename):
+    """Write the rgb channels of the field `img` to `args.outdir/filename`.
+    """
+    os.makedirs(args.outdir, exist_ok=True)
+    ti.tools.imwrite(img.to_numpy()[..., :3], os.path.join(args.outdir, filename))
+
+
+def run(args, name, step, img):
+    """Render `args.frames` frames without a window.
+
+    `step(t)` launches the kernels of one frame at animation time `t`,
+    afterwards the content of `img` is written as `{name}_{frame:05d}.png`
+    or appended to `{name}.y4m`.
+    """
+    t0 = time.perf_counter()
+    with recorder.Recorder(args.outdir, name, args.format, args.dt, args.queue) as rec:
+        for frame in range(args.frames):
+            step(frame * args.dt)
+            rec.push(img)
+    report(args, name, time.perf_counter() - t0)
+
+
+def run_batch(args, name, render, frame_time, frames):
+    """Render `args.frames` frames without a window, K at a time.
+
+    `render()` renders the frames at the K animation times in the field
+    `frame_time` into the framebuffers `frames` of shape (K, W, H) in one
+    launch, which are then written as `run` does.
+    """
+    K = frames.shape[0]
+    t0 = time.perf_counter()
+    with recorder.Recorder(args.outdir, name, args.format, args.dt, args.queue) as rec:
+        for start in range(0, args.frames, K):
+            frame_time.from_numpy(((start + np.arange(K)) * args.dt).astype(np.float32))
+            render()
+            batch = frames.to_numpy()
+            for k in range(min(K, args.frames - start)):
+                rec.push(batch[k])
+    report(args, name, time.perf_counter() - t0)
+
+
+def batch_fields(args, channels):
+    """The fields of the batch mode of a demo with a `batch` option, which
+    renders the frames at the times in `frame_time` into `frames[k]` with
+    one launch, in headless mode only.
+
+    Returns the number of frames per launch, 0 without batch mode,
+    `frame_time` and the framebuffers `frames` of shape (K, W, H) made by
+    `recorder.image`. Without batch mode they hold a single frame time and
+    pixel.
+    """
+    batch = args.batch if args.headless else 0
+    K = max(batch, 1)
+    frame_time = ti.field(float, shape=K)
+    frames = recorder.image((K, *args.res) if batch else (1, 1, 1), channels, args.packed)
+    return batch, frame_time, frames
+
+
+def report(args, name, elapsed):
+    print(f'{name}: {args.frames} frames at {args.res[0]}x{args.res[1]} '
+          f'in {elapsed:.2f}s ({args.frames / elapsed:.2f} fps) -> {args.outdir}')
@@ -1,19 +1,31 @@
 import time
+import warnings
+import numpy as np
 import taichi as ti
 import taichi.math as tm
+import headless
+import recorder
 
-ti.init(arch=ti.vulkan)
+args = headless.parse_args('N-body problem', res=(800, 640), particles=200,
+                           solver='direct', theta=0.5, check_error=False,
+                           substeps=10, time_step=1e-4, integrator='euler',
+                           fused=False, check_energy=False,
+                           renderer='binned', glare_cutoff=1 / 1024,
+                           check_render=False,
+                           pm_grid=256, pm_cutoff=5.0, p3m=False)
+ti.init(arch=ti.cpu if args.headless else ti.vulkan)
 
-res = (800, 640)  # window resolution
+res = args.res  # window resolution
 img = ti.Vector.field(3, float, shape=res)  # pixel colors
 iTime = ti.field(float, shape=())  # time elapsed up to current step
 aspect = res[0] / res[1]
 start_time = None
-substeps = 10
+substeps = args.substeps
+time_step = args.time_step  # simulated time per frame
 wrap_boundary = True  # use periodic boundary
 xmax = 1.0  # max distance in x-axis
 
-N = 200  # number of particles
+N = args.particles  # number of particles
 G = 1  # gravitational constant 6.67408e-11, using 1 for simplicity 
 pos = ti.Vector.field(2, float, N)  # particle positions, N x 2d vectors (x, y)
 vel = ti.Vector.field(2, float, N)  # particle velocities N x 2d vectors (vx, vy)
@@ -21,8 +33,20 @@ force = ti.Vector.field(2, float, N)  # particle forces N x 2d vectors (Fx, Fy)
 galaxy_size = 0.5  # galaxy size
 mass = 1  # particle mass
 init_vel = 120  # initial velocity
+solver = args.solver  # 'direct' sums over all pairs, 'barnes-hut' uses a quadtree, 'pm' a mesh
+theta = args.theta  # opening angle of the Barnes-Hut approximation
+integrator = args.integrator  # 'euler' (semi-implicit) or 'leapfrog' (kick-drift-kick)
+# Run all substeps of a frame in one kernel launch. The substeps of the
+# fused kernel are unrolled, so it is compiled anew for every --substeps
+# value and its code and compile time grow with the count.
+fused = args.fused
+if fused and solver != 'direct':
+    raise SystemExit('--fused requires --solver direct')
 lum_density = 40000.0
 star_size = 2.0
+renderer = args.renderer  # 'binned' only visits stars near a pixel, 'direct' visits all
+glare_cutoff = args.glare_cutoff  # brightness below which a star's glare is cut off
+tile_size = 16  # side length in pixels of the screen tiles stars are binned into
 
 @ti.func
 def hash11(x):
@@ -40,28 +64,119 @@ def get_particle_color(ind, lum):
     hue = tm.mix(-0.2, 0.2, hash11(ind + 13)) + 0.75 * iTime[None]
     return hsv2rgb(tm.vec3(hue, sat, lum))
     
+starhv = tm.vec2(9, 0.32)
+stardiag = tm.vec2(13, 0.61)
+
+@ti.func
+def pixel_uv(ij):
+    uv = 2 * tm.vec2(ij) / res - 1
+    uv *= xmax
+    uv.y /= aspect
+    return uv
+
+@ti.func
+def draw_particle(i, uv):
+    p = uv - pos[i]
+    q = 0.707 * tm.vec2(tm.dot(p, tm.vec2(1)), tm.dot(p, tm.vec2(1, -1)))
+    dists = tm.vec4(
+        tm.length(p * starhv),
+        tm.length(p * starhv.yx),
+        tm.length(q * stardiag),
+        tm.length(q * stardiag.yx)
+    ) * star_size + tm.vec4(0.015, tm.vec3(0.01))
+    lum0 = tm.mix(0.1, 3.2, hash11(i + 20))
+    lum1 = tm.dot(tm.vec4(0.65, 0.65, 0.2, 0.2), 1 / dists) + 1 / (p.norm() * star_size + 0.015)
+    lum = lum0 * pow(lum1, 2.2) / lum_density
+    return get_particle_color(i, lum)
+
 @ti.func
 def draw_particles(uv):
-    starhv = tm.vec2(9, 0.32)
-    stardiag = tm.vec2(13, 0.61)
     col = tm.vec3(0)
     for i in range(N):
-        p = uv - pos[i]
-        q = 0.707 * tm.vec2(tm.dot(p, tm.vec2(1)), tm.dot(p, tm.vec2(1, -1)))
-        dists = tm.vec4(
-            tm.length(p * starhv),
-            tm.length(p * starhv.yx),
-            tm.length(q * stardiag),
-            tm.length(q * stardiag.yx)
-        ) * star_size + tm.vec4(0.015, tm.vec3(0.01))
-        lum0 = tm.mix(0.1, 3.2, hash11(i + 20))
-        lum1 = tm.dot(tm.vec4(0.65, 0.65, 0.2, 0.2), 1 / dists) + 1 / (p.norm() * star_size + 0.015)
-        lum = lum0 * pow(lum1, 2.2) / lum_density
-        col += get_particle_color(i, lum)
+        col += draw_particle(i, uv)
     return col
 
+def glare_constant():
+    # Upper bound of lum1 * |p| * star_size in draw_particle over all
+    # directions of p, the constant offsets in dists only decrease lum1.
+    a = np.linspace(0, 2 * np.pi, 3600)
+    p = np.stack([np.cos(a), np.sin(a)], axis=1)
+    q = 0.707 * np.stack([p[:, 0] + p[:, 1], p[:, 0] - p[:, 1]], axis=1)
+    hv, diag = np.array([9, 0.32]), np.array([13, 0.61])
+    lum1 = (0.65 / np.linalg.norm(p * hv, axis=1) + 0.65 / np.linalg.norm(p * hv[::-1], axis=1)
+            + 0.2 / np.linalg.norm(q * diag, axis=1) + 0.2 / np.linalg.norm(q * diag[::-1], axis=1) + 1)
+    return lum1.max() * 1.01
+
+# A star is brighter than glare_cutoff only within glare_radius of its
+# center, so each pixel evaluates only the stars binned into its screen tile
+# and takes the dim remainder from the corners of the tile.
+glare_k = glare_constant() / star_size
+max_glare = glare_k * (3.2 / (lum_density * glare_cutoff)) ** (1 / 2.2)
+pixels_per_unit = res[0] / (2 * xmax)
+tiles = (-(-res[0] // tile_size), -(-res[1] // tile_size))
+max_span = int(2 * max_glare * pixels_per_unit) // tile_size + 2
+bin_capacity = N * min(tiles[0], max_span) * min(tiles[1], max_span)
+glare = ti.field(float, N)  # glare radius of each star
+tile_count = ti.field(int, tiles)  # number of stars binned into a tile
+tile_offset = ti.field(int, tiles)  # start of a tile's stars in bins
+far_glare = ti.Vector.field(3, float, tiles + (2, 2))  # stars not in a tile at its corner pixels
+bins = ti.field(int, bin_capacity)  # star indices grouped by tile
+
+@ti.func
+def tile_range(i):
+    lo = int(tm.floor(((pos[i] - glare[i]) * pixels_per_unit + tm.vec2(res) * 0.5) / tile_size))
+    hi = int(tm.floor(((pos[i] + glare[i]) * pixels_per_unit + tm.vec2(res) * 0.5) / tile_size))
+    return max(lo, 0), min(hi, tm.ivec2(tiles) - 1)
+
+@ti.kernel
+def bin_particles():
+    for I in ti.grouped(tile_count):
+        tile_count[I] = 0
+    for i in range(N):
+        lum0 = tm.mix(0.1, 3.2, hash11(i + 20))
+        glare[i] = glare_k * tm.pow(lum0 / (lum_density * glare_cutoff), 1 / 2.2)
+        lo, hi = tile_range(i)
+        for tx, ty in ti.ndrange((lo.x, hi.x + 1), (lo.y, hi.y + 1)):
+            tile_count[tx, ty] += 1
+
+    offset = 0
+    ti.loop_config(serialize=True)
+    for tx, ty in ti.ndrange(*tiles):
+        tile_offset[tx, ty] = offset
+        offset += tile_count[tx, ty]
+        tile_count[tx, ty] = 0
+
+    for i in range(N):
+        lo, hi = tile_range(i)
+        for tx, ty in ti.ndrange((lo.x, hi.x + 1), (lo.y, hi.y + 1)):
+            k = ti.atomic_add(tile_count[tx, ty], 1)
+            bins[tile_offset[tx, ty] + k] = i
+
+@ti.func
+def tile_corners(tx, ty):
+    # the first and the last pixel of tile (tx, ty)
+    lo = tm.ivec2(tx, ty) * tile_size
+    return lo, min(lo + tile_size, tm.ivec2(res)) - 1
+
+@ti.kernel
+def estimate_far_glare():
+    # The stars not binned into a tile are dimmer than glare_cutoff all
+    # over it, but with many stars their sum is not negligible. It is
+    # smooth over a tile and interpolated from its corners.
+    for tx, ty, cx, cy in far_glare:
+        lo, hi = tile_corners(tx, ty)
+        uv = pixel_uv(tm.ivec2(hi.x if cx else lo.x, hi.y if cy else lo.y))
+        col = tm.vec3(0)
+        for s in range(N):
+            slo, shi = tile_range(s)
+            if not (slo.x <= tx <= shi.x and slo.y <= ty <= shi.y):
+                col += draw_particle(s, uv)
+        far_glare[tx, ty, cx, cy] = col
+
 @ti.kernel
 def init_particles():
+    # serial, so that the random galaxy only depends on the seed
+    ti.loop_config(serialize=True)
     for i in range(N):
         theta = ti.random() * 2 * tm.pi
         r = tm.sqrt(ti.random() * 0.9 + 0.1) * xmax * galaxy_size
@@ -69,38 +184,427 @@ def init_particles():
         pos[i] = offset
         vel[i] = tm.vec2(-offset.y, offset.x) * init_vel
 
+@ti.func
+def gravity(i):
+    f = tm.vec2(0)
+    for j in range(N):
+        if i != j:
+            diff = pos[i] - pos[j]
+            r = diff.norm(1e-5)
+            # gravitational force -(GMm / r^2) * (diff/r) for i
+            f += -G * mass * mass * diff / r**3
+    return f
+
 @ti.kernel
 def compute_force():
     for i in range(N):
-        force[i] = [0, 0]  # clear forces
-    # compute gravitational force
+        force[i] = gravity(i)
+
+# Barnes-Hut quadtree. Nodes are allocated in a pool, node 0 is the root and
+# every node is stored after its parent. A node is either internal or a leaf
+# holding one particle. At max_depth, or once the pool is full, a node keeps
+# further particles in a list of its own instead of splitting, the traversal
+# sums them exactly whenever it opens the node.
+max_nodes = 8 * N + 1024
+max_depth = 20
+node_count = ti.field(int, shape=())
+node_internal = ti.field(int, max_nodes)  # whether the node has children
+node_center = ti.Vector.field(2, float, max_nodes)  # center of the node's square
+node_half = ti.field(float, max_nodes)  # half of the node's side length
+node_mass = ti.field(float, max_nodes)  # total mass inside the node
+node_com = ti.Vector.field(2, float, max_nodes)  # center of mass
+node_particle = ti.field(int, max_nodes)  # first particle kept by the node or -1
+particle_next = ti.field(int, N)  # next particle kept by the same node or -1
+node_children = ti.field(int, (max_nodes, 4))  # child per quadrant or -1
+node_first = ti.field(int, max_nodes)  # first existing child or -1
+node_next = ti.field(int, max_nodes)  # next node after skipping the subtree
+bbox = ti.Vector.field(2, float, 2)  # lower left and upper right corner
+
+@ti.func
+def new_node(center, half):
+    n = ti.atomic_add(node_count[None], 1)
+    node_center[n] = center
+    node_half[n] = half
+    node_mass[n] = 0
+    node_com[n] = [0, 0]
+    node_particle[n] = -1
+    node_internal[n] = 0
+    for q in ti.static(range(4)):
+        node_children[n, q] = -1
+    return n
+
+@ti.func
+def quadrant(n, p):
+    return int(p.x > node_center[n].x) + 2 * int(p.y > node_center[n].y)
+
+@ti.func
+def get_child(n, p):
+    # child of node n in the quadrant containing p, created if necessary,
+    # the caller checks that the pool has room for it
+    q = quadrant(n, p)
+    c = node_children[n, q]
+    if c == -1:
+        half = node_half[n] * 0.5
+        offset = tm.vec2(q % 2, q // 2) * 2 - 1
+        c = new_node(node_center[n] + offset * half, half)
+        node_children[n, q] = c
+    return c
+
+@ti.kernel
+def build_quadtree():
+    bbox[0] = [1e9, 1e9]
+    bbox[1] = [-1e9, -1e9]
+    for i in range(N):
+        ti.atomic_min(bbox[0], pos[i])
+        ti.atomic_max(bbox[1], pos[i])
+
+    node_count[None] = 0
+    extent = bbox[1] - bbox[0]
+    new_node((bbox[0] + bbox[1]) * 0.5, max(extent.x, extent.y) * 0.5 + 1e-5)
+
+    # insert the particles one after the other, accumulating mass and
+    # mass weighted positions along the path from the root
+    ti.loop_config(serialize=True)
+    for i in range(N):
+        p = pos[i]
+        n = 0
+        depth = 0
+        particle_next[i] = -1
+        while True:
+            node_mass[n] += mass
+            node_com[n] += mass * p
+            if not node_internal[n]:
+                if node_particle[n] == -1:
+                    node_particle[n] = i
+                    break
+                if depth >= max_depth or node_count[None] + 2 > max_nodes:
+                    # keep the particle in this leaf next to the others
+                    particle_next[i] = node_particle[n]
+                    node_particle[n] = i
+                    break
+                # split the leaf and move its only particle one level down
+                j = node_particle[n]
+                c = get_child(n, pos[j])
+                node_mass[c] = mass
+                node_com[c] = mass * pos[j]
+                node_particle[c] = j
+                node_particle[n] = -1
+                node_internal[n] = 1
+            if node_children[n, quadrant(n, p)] == -1 and node_count[None] + 1 > max_nodes:
+                # no room for the child, the internal node keeps the particle
+                particle_next[i] = node_particle[n]
+                node_particle[n] = i
+                break
+            n = get_child(n, p)
+            depth += 1
+
+    # center of mass pass
+    for n in range(node_count[None]):
+        node_com[n] /= node_mass[n]
+
+    # links for a stackless depth first traversal, parents are visited
+    # before their children
+    node_next[0] = -1
+    ti.loop_config(serialize=True)
+    for n in range(node_count[None]):
+        node_first[n] = -1
+        nxt = node_next[n]
+        for k in range(4):
+            c = node_children[n, 3 - k]
+            if c != -1:
+                node_next[c] = nxt
+                node_first[n] = c
+                nxt = c
+
+@ti.kernel
+def compute_force_barnes_hut():
     for i in range(N):
+        p = pos[i]
+        f = tm.vec2(0)
+        n = 0
+        while n != -1:
+            diff = p - node_com[n]
+            r = diff.norm(1e-5)
+            k = node_particle[n]
+            single = False
+            if not node_internal[n]:
+                single = particle_next[k] == -1
+            if single:
+                if k != i:
+                    f += -G * mass * node_mass[n] * diff / r**3
+                n = node_next[n]
+            elif 2 * node_half[n] < theta * r:
+                # a node far enough to be treated as one particle
+                f += -G * mass * node_mass[n] * diff / r**3
+                n = node_next[n]
+            else:
+                # open the node, the particles it keeps itself are summed
+                # exactly before its children are visited
+                while k != -1:
+                    if k != i:
+                        d = p - pos[k]
+                        f += -G * mass * mass * d / d.norm(1e-5)**3
+                    k = particle_next[k]
+                n = node_first[n] if node_first[n] != -1 else node_next[n]
+        force[i] = f
+
+# Particle-mesh gravity on the periodic domain [-xmax, xmax] x [-ymax, ymax].
+# The pair potential 1/r is split at pm_cutoff into a long-range part that is
+# smooth inside the cutoff and solved on the mesh with an FFT, and a short-range
+# remainder that vanishes beyond the cutoff and is summed over neighbor cells
+# if p3m is enabled.
+ymax = xmax / aspect
+pm_grid = (args.pm_grid, max(int(round(args.pm_grid / aspect)), 1))
+pm_h = tm.vec2(2 * xmax / pm_grid[0], 2 * ymax / pm_grid[1])  # mesh cell size
+pm_cutoff = args.pm_cutoff * max(pm_h.x, pm_h.y)  # split radius
+p3m = args.p3m
+density = ti.field(float, pm_grid)  # mass per area deposited on the mesh
+mesh_force = ti.Vector.field(2, float, pm_grid)  # force per unit mass on the mesh
+cells = (int(2 * xmax / pm_cutoff), int(2 * ymax / pm_cutoff))  # cell list, cell size >= pm_cutoff
+if min(cells) < 3:
+    raise SystemExit('--pm-cutoff is too large for the short-range cell list')
+if solver == 'pm' and not p3m:
+    warnings.warn(f'--solver pm without --p3m drops most of the force between particles closer '
+                  f'than {args.pm_cutoff} mesh cells, its relative force error is close to 1')
+cell_count = ti.field(int, cells)
+cell_offset = ti.field(int, cells)
+cell_particles = ti.field(int, N)  # particle indices grouped by cell
+
+def long_range_potential(r):
+    # 1/r outside the cutoff, continued to r = 0 by an even polynomial that
+    # matches its value and first two derivatives at the cutoff
+    u = np.minimum(r / pm_cutoff, 1)
+    return np.where(r < pm_cutoff, (15 / 8 - 5 / 4 * u**2 + 3 / 8 * u**4) / pm_cutoff,
+                    1 / np.maximum(r, 1e-30))
+
+def pm_kernel():
+    # Fourier transform of the long-range potential sampled at the minimum
+    # image offsets of the mesh cells
+    dx = np.fft.fftfreq(pm_grid[0], 1 / pm_grid[0]) * pm_h.x
+    dy = np.fft.fftfreq(pm_grid[1], 1 / pm_grid[1]) * pm_h.y
+    r = np.hypot(dx[:, None], dy[None, :])
+    return np.fft.rfft2(long_range_potential(r)) * pm_h.x * pm_h.y
+
+pm_kernel_hat = pm_kernel()
+
+@ti.func
+def cic(p):
+    # lower left mesh cell and bilinear weights of position p, the mesh
+    # cell centers are at (i + 0.5) * pm_h - (xmax, ymax)
+    g = (p + tm.vec2(xmax, ymax)) / pm_h - 0.5
+    base = tm.floor(g)
+    return int(base), g - base
+
+@ti.kernel
+def deposit():
+    for I in ti.grouped(density):
+        density[I] = 0
+    for i in range(N):
+        base, f = cic(pos[i])
+        for dx, dy in ti.static(ti.ndrange(2, 2)):
+            w = (f.x if dx else 1 - f.x) * (f.y if dy else 1 - f.y)
+            cell = (base + tm.ivec2(dx, dy)) % tm.ivec2(pm_grid)
+            density[cell] += mass * w / (pm_h.x * pm_h.y)
+
+@ti.kernel
+def interpolate_force():
+    for i in range(N):
+        base, f = cic(pos[i])
+        acc = tm.vec2(0)
+        for dx, dy in ti.static(ti.ndrange(2, 2)):
+            w = (f.x if dx else 1 - f.x) * (f.y if dy else 1 - f.y)
+            acc += w * mesh_force[(base + tm.ivec2(dx, dy)) % tm.ivec2(pm_grid)]
+        force[i] = mass * acc
+
+def solve_mesh():
+    rho_hat = np.fft.rfft2(density.to_numpy())
+    rho_hat[0, 0] = 0  # the mean density does not exert a force
+    phi = -G * np.fft.irfft2(pm_kernel_hat * rho_hat, s=pm_grid)
+    acc = np.stack([
+        -(np.roll(phi, -1, 0) - np.roll(phi, 1, 0)) / (2 * pm_h.x),
+        -(np.roll(phi, -1, 1) - np.roll(phi, 1, 1)) / (2 * pm_h.y),
+    ], axis=-1)
+    mesh_force.from_numpy(acc.astype(np.float32))
+
+@ti.func
+def cell_of(p):
+    c = int(tm.floor((p + tm.vec2(xmax, ymax)) / (2 * tm.vec2(xmax, ymax)) * tm.vec2(cells)))
+    return c % tm.ivec2(cells)
+
+@ti.kernel
+def short_range_force():
+    for I in ti.grouped(cell_count):
+        cell_count[I] = 0
+    for i in range(N):
+        cell_count[cell_of(pos[i])] += 1
+
+    offset = 0
+    ti.loop_config(serialize=True)
+    for cx, cy in ti.ndrange(*cells):
+        cell_offset[cx, cy] = offset
+        offset += cell_count[cx, cy]
+        cell_count[cx, cy] = 0
+
+    for i in range(N):
+        c = cell_of(pos[i])
+        cell_particles[cell_offset[c] + ti.atomic_add(cell_count[c], 1)] = i
+
+    for i in range(N):
+        c = cell_of(pos[i])
+        f = tm.vec2(0)
+        for dx, dy in ti.ndrange((-1, 2), (-1, 2)):
+            nc = (c + tm.ivec2(dx, dy)) % tm.ivec2(cells)
+            for k in range(cell_offset[nc], cell_offset[nc] + cell_count[nc]):
+                j = cell_particles[k]
+                diff = pos[i] - pos[j]
+                diff -= tm.round(diff / (2 * tm.vec2(xmax, ymax))) * 2 * tm.vec2(xmax, ymax)
+                r = diff.norm()
+                if j != i and r < pm_cutoff:
+                    # full pair force minus its long-range part from the mesh
+                    u = r / pm_cutoff
+                    f += -G * mass * mass * diff * (
+                        1 / diff.norm(1e-5)**3 - (5 / 2 - 3 / 2 * u * u) / pm_cutoff**3)
+        force[i] += f
+
+def compute_force_pm():
+    deposit()
+    solve_mesh()
+    interpolate_force()
+    if p3m:
+        short_range_force()
+
+def update_force():
+    if solver == 'barnes-hut':
+        build_quadtree()
+        compute_force_barnes_hut()
+    elif solver == 'pm':
+        compute_force_pm()
+    else:
+        compute_force()
+
+@ti.kernel
+def compute_force_minimum_image():
+    # all pairs on the periodic domain of the mesh solvers, every pair at
+    # its nearest periodic image
+    period = 2 * tm.vec2(xmax, ymax)
+    for i in range(N):
+        f = tm.vec2(0)
         for j in range(N):
             if i != j:
                 diff = pos[i] - pos[j]
+                diff -= tm.round(diff / period) * period
                 r = diff.norm(1e-5)
-                # gravitational force -(GMm / r^2) * (diff/r) for i
-                f = -G * mass * mass * diff / r**3
-                # assign to each particle
-                force[i] += f
+                f += -G * mass * mass * diff / r**3
+        force[i] = f
+
+def force_error():
+    """Relative RMS error of the selected solver's forces against all pairs,
+    taken at their minimum image for the periodic mesh solvers."""
+    if solver == 'pm':
+        compute_force_minimum_image()
+    else:
+        compute_force()
+    reference = force.to_numpy()
+    update_force()
+    err = force.to_numpy() - reference
+    return ((err**2).sum() / (reference**2).sum()) ** 0.5
+
+@ti.func
+def wrap(i):
+    if ti.static(wrap_boundary):
+        if abs(pos[i].x) > xmax:
+            pos[i].x = -pos[i].x
+        if abs(pos[i].y) > xmax / aspect:
+            pos[i].y = -pos[i].y
 
 @ti.kernel
 def update_pos_vel():
-    dt = 1e-4 / substeps
+    dt = time_step / substeps
     for i in range(N):
         vel[i] += dt * force[i] / mass
         pos[i] += dt * vel[i]
-        if ti.static(wrap_boundary):
-            if abs(pos[i].x) > xmax:
-                pos[i].x = -pos[i].x
-            if abs(pos[i].y) > xmax / aspect:
-                pos[i].y = -pos[i].y
+        wrap(i)
+
+@ti.kernel
+def kick_drift():
+    dt = time_step / substeps
+    for i in range(N):
+        vel[i] += 0.5 * dt * force[i] / mass
+        pos[i] += dt * vel[i]
+        wrap(i)
+
+@ti.kernel
+def kick():
+    dt = time_step / substeps
+    for i in range(N):
+        vel[i] += 0.5 * dt * force[i] / mass
+
+@ti.kernel
+def advance(num_substeps: ti.template()):
+    # All substeps of a frame in one launch. The substeps depend on each
+    # other, so they are unrolled at compile time and every per-particle
+    # loop stays an outermost, parallel loop of the kernel. The price is a
+    # kernel compiled per substep count, with code growing linearly in it.
+    dt = time_step / num_substeps
+    for _ in ti.static(range(num_substeps)):
+        if ti.static(integrator == 'leapfrog'):
+            for i in range(N):
+                vel[i] += 0.5 * dt * force[i] / mass
+                pos[i] += dt * vel[i]
+                wrap(i)
+            for i in range(N):
+                force[i] = gravity(i)
+            for i in range(N):
+                vel[i] += 0.5 * dt * force[i] / mass
+        else:
+            for i in range(N):
+                force[i] = gravity(i)
+            for i in range(N):
+                vel[i] += dt * force[i] / mass
+                pos[i] += dt * vel[i]
+                wrap(i)
+
+def simulate():
+    """Advance the particles by one frame, i.e. `substeps` substeps."""
+    if fused:
+        advance(substeps)
+    elif integrator == 'leapfrog':
+        # the force at the current positions is known from the last substep
+        for _ in range(substeps):
+            kick_drift()
+            update_force()
+            kick()
+    else:
+        for _ in range(substeps):
+            update_force()
+            update_pos_vel()
+
+@ti.kernel
+def total_energy() -> float:
+    e = 0.0
+    for i in range(N):
+        e += 0.5 * mass * vel[i].norm_sqr()
+        for j in range(N):
+            if i != j:
+                e -= 0.5 * G * mass * mass / (pos[i] - pos[j]).norm(1e-5)
+    return e
+
+def energy_drift(frames):
+    """Largest relative change of the total energy within `frames` frames."""
+    e0 = total_energy()
+    drift = 0.0
+    for _ in range(frames):
+        simulate()
+        drift = max(drift, abs(total_energy() - e0) / abs(e0))
+    return drift
 
 def init():
     global start_time
     start_time = time.perf_counter()
     iTime[None] = 0
+    img.fill(0)
     init_particles()
+    update_force()
 
 def update_time():
     iTime[None] = time.perf_counter() - start_time
@@ -108,28 +612,96 @@ def update_time():
 @ti.kernel
 def render():
     for i, j in img:
-        uv = 2 * tm.vec2(i, j) / res - 1
-        uv *= xmax
-        uv.y /= aspect
-        img[i, j] = img[i, j] * 0.75 + draw_particles(uv) * 0.9
-
-gui = ti.ui.Window("N-body problem", res=res)
-canvas = gui.get_canvas()
-init()
-while gui.running:
-    if gui.is_pressed("r"):
-        init()
+        img[i, j] = img[i, j] * 0.75 + draw_particles(pixel_uv(tm.ivec2(i, j))) * 0.9
+
+@ti.kernel
+def render_binned():
+    for i, j in img:
+        uv = pixel_uv(tm.ivec2(i, j))
+        tx, ty = i // tile_size, j // tile_size
+        lo, hi = tile_corners(tx, ty)
+        f = (tm.vec2(i, j) - lo) / max(hi - lo, 1)
+        col = tm.mix(tm.mix(far_glare[tx, ty, 0, 0], far_glare[tx, ty, 1, 0], f.x),
+                     tm.mix(far_glare[tx, ty, 0, 1], far_glare[tx, ty, 1, 1], f.x), f.y)
+        for k in range(tile_offset[tx, ty], tile_offset[tx, ty] + tile_count[tx, ty]):
+            col += draw_particle(bins[k], uv)
+        img[i, j] = img[i, j] * 0.75 + col * 0.9
 
-    if gui.is_pressed("p"):
+def draw():
+    if renderer == 'binned':
+        bin_particles()
+        estimate_far_glare()
+        render_binned()
+    else:
+        render()
+
+def render_difference(frames):
+    """Mean absolute difference and PSNR of the binned renderer against
+    the direct one after `frames` frames, both with their feedback."""
+    images = [np.zeros(res + (3,), np.float32) for _ in range(2)]
+    for frame in range(frames):
+        iTime[None] = frame * args.dt
+        simulate()
+        for k in range(2):
+            img.from_numpy(images[k])
+            if k:
+                bin_particles()
+                estimate_far_glare()
+                render_binned()
+            else:
+                render()
+            images[k] = img.to_numpy()
+    direct, binned = (np.clip(x, 0, 1) for x in images)
+    mse = np.mean((direct - binned) ** 2)
+    return np.abs(direct - binned).mean(), 10 * np.log10(1 / max(mse, 1e-20))
+
+def render_offline():
+    init()
+
+    def step(t):
+        iTime[None] = t
+        simulate()
+        draw()
+
+    headless.run(args, 'nbody', step, img)
+
+def main():
+    gui = ti.ui.Window("N-body problem", res=res)
+    canvas = gui.get_canvas()
+    init()
+    rec = None
+    while gui.running:
+        if gui.get_event(ti.ui.PRESS) and gui.event.key == "p":
+            rec = recorder.toggle(rec, args, "nbody")
+
+        if gui.is_pressed("r"):
+            init()
+
+        update_time()
+        simulate()
+        draw()
+        if rec is not None:
+            rec.push(img)
         canvas.set_image(img)
-        gui.write_image("screenshot.png")
         gui.show()
 
-    for _ in range(substeps):
-        update_time()
-        compute_force()
-        update_pos_vel()
+    if rec is not None:
+        rec.close()
 
-    render()
-    canvas.set_image(img)
-    gui.show()
+if __name__ == "__main__":
+    if args.check_error:
+        init()
+        print(f"{solver}, N = {N}: relative force error {force_error():.2e}")
+    elif args.check_render:
+        init()
+        diff, psnr = render_difference(args.frames)
+        print(f"N = {N}, {args.frames} frames at {res[0]}x{res[1]}: binned renderer differs by "
+              f"{diff:.4f} on average, PSNR {psnr:.1f} dB")
+    elif args.check_energy:
+        init()
+        print(f"{integrator}, {substeps} substeps of {time_step / substeps:.2e}: "
+              f"relative energy drift {energy_drift(args.frames):.2e} in {args.frames} frames")
+    elif args.headless:
+        render_offline()
+    else:
+        main()
@@ -1,19 +1,32 @@
 """
 Poisson disk sampling in Taichi.
 Based on code by Yuanming Hu: https://github.com/taichi-dev/poisson_disk_sampling
+
+Besides the serial Bridson queue that grows the samples from the mouse
+position, `--parallel` fills the grid by phase-grouped dart throwing, and
+`--bench` compares both generators, e.g.
+
+    python poisson_disk_sampling.py --bench --grid-n 1000 --samples 1000000
+    python poisson_disk_sampling.py --bench --parallel --dim 3 --grid-n 100
 """
+import time
 import taichi as ti
 import taichi.math as tm
+import headless
+import recorder
 
+args = headless.parse_args("Poisson Disk Sampling", res=(800, 800), grid_n=20, samples=200,
+                           parallel=False, dim=2, rounds=2, attempts=4, bench=False)
 ti.init(arch=ti.cpu)
 
-grid_n = 20
+dim = args.dim  # the serial generator and the visualization are 2d only
+grid_n = args.grid_n
 dx = 1 / grid_n
-radius = dx * tm.sqrt(2)
-desired_samples = 200
-grid = ti.field(dtype=int, shape=(grid_n, grid_n))
-samples = ti.Vector.field(2, dtype=float, shape=desired_samples)
-window_size = 800
+radius = dx * tm.sqrt(dim)  # a grid cell contains at most one sample
+desired_samples = args.samples
+grid = ti.field(dtype=int, shape=(grid_n,) * dim)
+samples = ti.Vector.field(dim, dtype=float, shape=max(desired_samples, grid_n**dim))
+window_size = min(args.res)  # the sampling domain is a square
 dfield = ti.Vector.field(4, dtype=float, shape=(window_size, window_size))
 img = ti.Vector.field(3, dtype=float, shape=(window_size, window_size))
 iMouse = ti.Vector.field(2, dtype=float, shape=())
@@ -35,12 +48,12 @@ def refresh_scene():
     tail[None] = 1
     sample_count[None] = 1
 
-    samples[0] = (p0 := iMouse[None])
-    grid[coord_to_index(p0)] = 0
-
     for i, j in grid:
         grid[i, j] = -1
 
+    samples[0] = (p0 := iMouse[None])
+    grid[coord_to_index(p0)] = 0
+
     for i, j in dfield:
         dfield[i, j] = tm.vec4(1e5)
         img[i, j] = tm.vec3(1)
@@ -84,6 +97,88 @@ def poisson_disk_sample(num_samples: int) -> int:
     return tail[None]
 
 
+@ti.func
+def has_neighbor(p):
+    # whether a sample closer than radius to p exists, in any dimension
+    I = int(p * grid_n)
+    found = False
+    for offset in ti.static(ti.grouped(ti.ndrange(*((-2, 3),) * dim))):
+        J = I + offset
+        if all(J >= 0) and all(J < grid_n):
+            ind = grid[J]
+            if ind != -1 and (samples[ind] - p).norm() < radius - 1e-6:
+                found = True
+    return found
+
+
+@ti.kernel
+def clear_samples():
+    for I in ti.grouped(grid):
+        grid[I] = -1
+    sample_count[None] = 0
+
+
+@ti.kernel
+def throw_darts(phase: int, attempts: int):
+    # Cells whose indices are congruent mod 3 are at least two cells, i.e.
+    # more than radius, apart and never test each other's samples, so all
+    # cells of one of the 3^dim phases are processed in parallel.
+    shift = ti.Vector([phase // 3**k % 3 for k in ti.static(range(dim))])
+    for I in ti.grouped(ti.ndrange(*((-(-grid_n // 3)),) * dim)):
+        cell = I * 3 + shift
+        if all(cell < grid_n) and grid[cell] == -1:
+            for _ in range(attempts):
+                p = (cell + ti.Vector([ti.random() for _ in ti.static(range(dim))])) * dx
+                if not has_neighbor(p):
+                    ind = ti.atomic_add(sample_count[None], 1)
+                    samples[ind] = p
+                    grid[cell] = ind
+                    break
+
+
+def parallel_poisson_disk_sample():
+    """Fill the unit square (cube) with samples, returns the number of samples."""
+    clear_samples()
+    for _ in range(args.rounds):
+        for phase in range(3**dim):
+            throw_darts(phase, args.attempts)
+    return sample_count[None]
+
+
+@ti.kernel
+def min_distance(n: int) -> float:
+    dmin = 1e5
+    for i in range(n):
+        p = samples[i]
+        I = int(p * grid_n)
+        for offset in ti.static(ti.grouped(ti.ndrange(*((-2, 3),) * dim))):
+            J = I + offset
+            if all(J >= 0) and all(J < grid_n):
+                ind = grid[J]
+                if ind != -1 and ind != i:
+                    ti.atomic_min(dmin, (samples[ind] - p).norm())
+    return dmin
+
+
+def bench():
+    """Time both generators and check the minimum distance of their samples."""
+    generators = [("parallel", parallel_poisson_disk_sample)]
+    if dim == 2:
+        def serial():
+            refresh_scene()
+            return poisson_disk_sample(desired_samples)
+        generators.insert(0, ("serial", serial))
+
+    for name, generate in generators:
+        generate()  # compile
+        t0 = time.perf_counter()
+        n = generate()
+        ti.sync()
+        elapsed = time.perf_counter() - t0
+        print(f"{name}: {n} samples in {elapsed * 1e3:.1f} ms ({n / elapsed / 1e6:.2f} M samples/s), "
+              f"min distance {min_distance(n) / radius:.4f} * radius")
+
+
 @ti.func
 def hash21(p):
     return tm.fract(tm.sin(tm.dot(p, tm.vec2(127.619, 157.583))) * 43758.5453)
@@ -96,61 +191,141 @@ def sample_dist(uv):
     return dfield[x, y]
 
 
+@ti.func
+def distance_pixel(i, j):
+    uv = tm.vec2(i, j) / iResolution
+    d, p = find_nearest_point(uv)
+    d = (uv - p).norm() - radius / 2.
+    dfield[i, j] = tm.vec4(d, p.x, p.y, radius / 2.)
+
+
 @ti.kernel
 def compute_distance_field():
     for i, j in dfield:
-        uv = tm.vec2(i, j) / iResolution
-        d, p = find_nearest_point(uv)
-        d = (uv - p).norm() - radius / 2.
-        dfield[i, j] = tm.vec4(d, p.x, p.y, radius / 2.)
+        distance_pixel(i, j)
+
+
+@ti.func
+def render_pixel(i, j):
+    uv = tm.vec2(i, j) / iResolution.y
+    st = tm.fract(uv * grid_n) - 0.5
+    dg = 0.5 - abs(st)
+    d1 = min(dg.x, dg.y)
+    d1 = tm.smoothstep(0.05, 0.0, d1)
+    col = (1 - tm.vec3(d1)) * 0.7
+    sf = 2 / iResolution.y
+    buf = sample_dist(uv)
+    bufSh = sample_dist(uv + tm.vec2(0.005, 0.015))
+    cCol = tm.vec3(hash21(buf.yz + 0.3),  hash21(buf.yz), hash21(buf.yz + 0.09))
+    pat = (abs(tm.fract(-buf.x * 150.0) - 0.5) * 2) / 300
+    col = tm.mix(col, tm.vec3(0), (1 - tm.smoothstep(0, 3 * sf, pat)) * 0.25)
+    ew, ew2 = 0.005, 0.008
+    cCol2 = tm.mix(cCol, tm.vec3(1), 0.9)
+    col = tm.mix(col, tm.vec3(0),  (1 - tm.smoothstep(0, sf * 2, bufSh.x)) * 0.4)
+    col = tm.mix(col, tm.vec3(0),  1 - tm.smoothstep(sf, 0, -buf.x))
+    col = tm.mix(col, cCol2,  1 - tm.smoothstep(sf, 0, -buf.x - ew))
+    col = tm.mix(col, tm.vec3(0),  1 - tm.smoothstep(sf, 0, -buf.x - ew2 - ew))
+    col = tm.mix(col, cCol,  1 - tm.smoothstep(sf, 0., -buf.x - ew2 - ew * 2))
+    col = tm.sqrt(max(col, 0))
+    img[i, j] = col
 
 
 @ti.kernel
 def render():
     for i, j in img:
-        uv = tm.vec2(i, j) / iResolution.y
-        st = tm.fract(uv * grid_n) - 0.5
-        dg = 0.5 - abs(st)
-        d1 = min(dg.x, dg.y)
-        d1 = tm.smoothstep(0.05, 0.0, d1)
-        col = (1 - tm.vec3(d1)) * 0.7
-        sf = 2 / iResolution.y
-        buf = sample_dist(uv)
-        bufSh = sample_dist(uv + tm.vec2(0.005, 0.015))
-        cCol = tm.vec3(hash21(buf.yz + 0.3),  hash21(buf.yz), hash21(buf.yz + 0.09))
-        pat = (abs(tm.fract(-buf.x * 150.0) - 0.5) * 2) / 300
-        col = tm.mix(col, tm.vec3(0), (1 - tm.smoothstep(0, 3 * sf, pat)) * 0.25)
-        ew, ew2 = 0.005, 0.008
-        cCol2 = tm.mix(cCol, tm.vec3(1), 0.9)
-        col = tm.mix(col, tm.vec3(0),  (1 - tm.smoothstep(0, sf * 2, bufSh.x)) * 0.4)
-        col = tm.mix(col, tm.vec3(0),  1 - tm.smoothstep(sf, 0, -buf.x))
-        col = tm.mix(col, cCol2,  1 - tm.smoothstep(sf, 0, -buf.x - ew))
-        col = tm.mix(col, tm.vec3(0),  1 - tm.smoothstep(sf, 0, -buf.x - ew2 - ew))
-        col = tm.mix(col, cCol,  1 - tm.smoothstep(sf, 0., -buf.x - ew2 - ew * 2))
-        col = tm.sqrt(max(col, 0))
-        img[i, j] = col
-
-
-refresh_scene()
-gui = ti.ui.Window("Poisson Disk Sampling", res=(window_size, window_size))
-canvas = gui.get_canvas()
-gui.fps_limit = 10
-while gui.running:
-    gui.get_event(ti.ui.PRESS)
-    if gui.is_pressed(ti.ui.ESCAPE):
-        gui.running = False
-
-    if gui.is_pressed(ti.ui.LMB):
-        iMouse[None] = gui.get_cursor_pos()
-        refresh_scene()
-
-    if gui.is_pressed("p"):
-        canvas.set_image(img)
-        gui.write_image("screenshot.png")
+        render_pixel(i, j)
+
+
+# A sample only changes the pixels whose 5x5 grid cell neighborhood in
+# find_nearest_point contains it, i.e. a box of 5 cells around its cell.
+# A rendered pixel also reads the distance at a shadow offset, so the box
+# to redraw extends by that offset.
+cell_pixels = window_size / grid_n
+dirty_size = int(5 * cell_pixels) + 2
+shadow = tm.ivec2(int(0.005 * window_size) + 1, int(0.015 * window_size) + 1)
+
+
+@ti.func
+def dirty_corner(k):
+    return int((coord_to_index(samples[k]) - 2) * cell_pixels)
+
+
+@ti.kernel
+def update_distance_field(first: int, last: int):
+    for k, di, dj in ti.ndrange((first, last), dirty_size, dirty_size):
+        i, j = dirty_corner(k) + tm.ivec2(di, dj)
+        if 0 <= i < window_size and 0 <= j < window_size:
+            distance_pixel(i, j)
+
+
+@ti.kernel
+def render_dirty(first: int, last: int):
+    for k, di, dj in ti.ndrange((first, last), dirty_size + shadow.x, dirty_size + shadow.y):
+        i, j = dirty_corner(k) - shadow + tm.ivec2(di, dj)
+        if 0 <= i < window_size and 0 <= j < window_size:
+            render_pixel(i, j)
 
-    poisson_disk_sample(sample_count[None])
-    sample_count[None] += 1
+
+def update_visualization(first, last):
+    """Redraw after the samples `first` to `last` - 1 were added."""
+    if (last - first) * (dirty_size + shadow.y) ** 2 >= window_size ** 2:
+        compute_distance_field()
+        render()
+    elif last > first:
+        update_distance_field(first, last)
+        render_dirty(first, last)
+
+
+def advance(t=0):
+    if not args.parallel:
+        first = tail[None]
+        poisson_disk_sample(sample_count[None])
+        sample_count[None] += 1
+        update_visualization(first, tail[None])
+
+
+def refresh():
+    refresh_scene()
+    if args.parallel:
+        parallel_poisson_disk_sample()
     compute_distance_field()
     render()
-    canvas.set_image(img)
-    gui.show()
+
+
+def main():
+    gui = ti.ui.Window("Poisson Disk Sampling", res=(window_size, window_size))
+    canvas = gui.get_canvas()
+    gui.fps_limit = 10
+    rec = None
+    while gui.running:
+        if gui.get_event(ti.ui.PRESS) and gui.event.key == "p":
+            rec = recorder.toggle(rec, args, "poisson_disk_sampling")
+        if gui.is_pressed(ti.ui.ESCAPE):
+            gui.running = False
+
+        if gui.is_pressed(ti.ui.LMB):
+            iMouse[None] = gui.get_cursor_pos()
+            refresh()
+
+        advance()
+        if rec is not None:
+            rec.push(img)
+        canvas.set_image(img)
+        gui.show()
+
+    if rec is not None:
+        rec.close()
+
+
+if __name__ == "__main__":
+    if args.bench:
+        bench()
+    elif dim != 2:
+        raise SystemExit("samples in 3d are only generated by --bench")
+    elif args.headless:
+        refresh()
+        headless.run(args, "poisson_disk_sampling", advance, img)
+    else:
+        refresh()
+        main()
+
@@ -2,19 +2,67 @@
 import time
 import taichi as ti
 import taichi.math as tm
+import governor
+import headless
+import recorder
+import temporal
 
-ti.init(arch=ti.vulkan)
+args = headless.parse_args('Protean Clouds', res=(960, 640), temporal=1, skip=False,
+                           skip_margin=0.25, step_stats=False, target_fps=0.0,
+                           packed=False)
+ti.init(arch=ti.cpu if args.headless else ti.vulkan)
 
-W, H = 960, 640
+W, H = args.res
 MAXITER = 130
 iResolution = tm.vec2(W, H)
 iTime = ti.field(float, shape=())
 iMouse = ti.Vector.field(2, float, shape=())
 
-img = ti.Vector.field(3, float, shape=(W, H))
+img = recorder.image((W, H), 3, args.packed)
 
+maxiter_budget = ti.field(int, shape=())  # march steps, at most MAXITER
+gov = governor.Governor(args.target_fps, {'MAXITER': (maxiter_budget, 40, MAXITER)})
+
+# Per frame uniforms, written by update_uniforms before the pixels are
+# rendered. cam[0] is the camera of this frame, cam[1] the one of the
+# previous frame for the reprojection of the temporal mode.
 prm1 = ti.field(float, shape=())
 bsMo = ti.Vector.field(2, float, shape=())
+Camera = ti.types.struct(ro=tm.vec3, rightdir=tm.vec3, updir=tm.vec3, target=tm.vec3, roll=tm.mat2)
+cam = Camera.field(shape=2)
+
+# Temporal mode renders 1 / temporal_factor of the pixels per frame, see
+# temporal.py. Pixels are reprojected from the depth at which their
+# opacity reached 0.5.
+temporal_factor = args.temporal
+history = ti.Vector.field(3, float, shape=(W, H) if temporal_factor > 1 else (1, 1))
+depth = ti.field(float, shape=(W, H) if temporal_factor > 1 else (1, 1))
+# the colors of the frame being resolved, `img` itself unless it is packed
+current = ti.Vector.field(3, float, shape=(W, H)) if args.packed and temporal_factor > 1 else img
+frame = 0
+last = None  # iTime and iMouse of the previous frame
+
+# Empty space skipping: map(p).x is density(p) + 0.2 * cl + 0.25 with cl the
+# squared distance of p from the tunnel axis disp(z). Every frame the grid
+# stores density() on the vertices of a box around the tunnel in front of
+# the camera. A cell bounds it by the maximum over the vertices of the
+# 4x4x4 block around it plus skip_margin. Where the bound of map(p).x is
+# not positive a march step only adds fog, which needs no map() call.
+skip = args.skip
+skip_margin = args.skip_margin
+kGridN = (32, 32, 80)
+kGridHalf = 8.0  # half width of the box across the tunnel
+kGridDepth = 40.0
+kGridCell = tm.vec3(2 * kGridHalf / kGridN[0], 2 * kGridHalf / kGridN[1], kGridDepth / kGridN[2])
+grid_vertex = ti.field(float, shape=tuple(n + 1 for n in kGridN) if skip else (1, 1, 1))
+grid_max = ti.field(float, shape=kGridN if skip else (1, 1, 1))
+grid_z0 = ti.field(float, shape=())
+
+step_stats = args.step_stats
+# map() calls and render() calls of every pixel since init, summed in
+# numpy, which does not overflow
+map_calls = ti.field(int, shape=(W, H) if step_stats else 1)
+shaded = ti.field(int, shape=(W, H) if step_stats else 1)
 
 m3 = tm.mat3([[0.33338, 0.56034, -0.71817],
               [-0.87887, 0.32651, -0.15323],
@@ -26,6 +74,8 @@ def init():
     iMouse[None] = (0, 0)
     prm1[None] = 0
     bsMo[None] = (0, 0)
+    map_calls.fill(0)
+    shaded.fill(0)
     return time.perf_counter()
 
 
@@ -40,12 +90,9 @@ def disp(t):
 
 
 @ti.func
-def map(p):
-    p2 = p
-    p2.xy -= disp(p.z).xy
+def density(p):
     m = tm.rot2(-tm.sin(p.z + iTime[None]) * (0.1 + prm1[None] * 0.05) - iTime[None] * 0.09)
     p.xy = m @ p.xy
-    cl = tm.dot(p2.xy, p2.xy)
     d = 0.
     p *= .61
     z = 1.
@@ -58,8 +105,44 @@ def map(p):
         trk *= 1.4
         p = m3.transpose() @ p
 
-    d = abs(d + prm1[None] * 3.) + prm1[None] * 0.3 - 2.5 + bsMo[None].y
-    return tm.vec2(d + cl * 0.2 + 0.25, cl)
+    return abs(d + prm1[None] * 3.) + prm1[None] * 0.3 - 2.5 + bsMo[None].y
+
+
+@ti.func
+def map(p):
+    p2 = p
+    p2.xy -= disp(p.z).xy
+    cl = tm.dot(p2.xy, p2.xy)
+    return tm.vec2(density(p) + cl * 0.2 + 0.25, cl)
+
+
+@ti.kernel
+def build_grid():
+    z0 = cam[0].ro.z
+    grid_z0[None] = z0
+    for I in ti.grouped(grid_vertex):
+        x = I * kGridCell - tm.vec3(kGridHalf, kGridHalf, 0)
+        z = z0 + x.z
+        grid_vertex[I] = density(tm.vec3(disp(z) + x.xy, z))
+
+    for I in ti.grouped(grid_max):
+        hi = -1e9
+        for J in ti.static(ti.grouped(ti.ndrange(4, 4, 4))):
+            hi = max(hi, grid_vertex[tm.clamp(I + J - 1, 0, tm.ivec3(kGridN))])
+        grid_max[I] = hi + skip_margin
+
+
+@ti.func
+def empty(p):
+    # whether the grid bounds map(p).x by 0
+    result = False
+    q = p
+    q.xy -= disp(p.z)
+    q.z -= grid_z0[None]
+    c = int(tm.floor((q + tm.vec3(kGridHalf, kGridHalf, 0)) / kGridCell))
+    if all(c >= 0) and all(c < tm.ivec3(kGridN)):
+        result = grid_max[c] + tm.dot(q.xy, q.xy) * 0.2 + 0.25 <= 0
+    return result
 
 
 @ti.func
@@ -69,16 +152,22 @@ def render(ro, rd, time):
     lpos = tm.vec3(disp(time + ldst) * 0.5, time + ldst)
     t = 1.5
     fogT = 0.
-    for _ in range(MAXITER):
+    dpt = -1.0
+    calls = 0
+    for _ in range(maxiter_budget[None]):
         if rez.a > 0.99:
             break
 
         pos = ro + t*rd
-        mpv = map(pos)
+        mpv = tm.vec2(0)  # any value <= 0 makes this step add fog only
+        if not (ti.static(skip) and empty(pos)):
+            mpv = map(pos)
+            calls += 1
         den = tm.clamp(mpv.x - 0.3, 0, 1) * 1.12
         dn = tm.clamp((mpv.x + 2.), 0, 3)
         col = tm.vec4(0)
         if mpv.x > 0.6:
+            calls += 2
             col = tm.vec4(
                 tm.sin(tm.vec3(5, 0.4, 0.2) + mpv.y * 0.1 + tm.sin(pos.z * 0.4) * 0.5 + 1.8) * 0.5 + 0.5, 0.08
             )
@@ -92,8 +181,12 @@ def render(ro, rd, time):
         col += tm.vec4(0.06, 0.11, 0.11, 0.1) * tm.clamp(fogC - fogT, 0, 1)
         fogT = fogC
         rez = rez + col * (1 - rez.a)
+        if dpt < 0 and rez.a > 0.5:
+            dpt = t
         t += tm.clamp(0.5 - dn * dn * 0.05, 0.09, 0.3)
-    return tm.clamp(rez, 0, 1)
+    if dpt < 0:
+        dpt = t
+    return tm.clamp(rez, 0, 1), dpt, calls
 
 
 @ti.func
@@ -116,45 +209,134 @@ def iLerp(a, b, x):
     return tm.clamp(ic, 0, 1)
 
 
+@ti.func
+def camera(time):
+    # the origin, the basis and the roll rotation of the camera at `time`
+    ro = tm.vec3(0, 0, time)
+    ro += tm.vec3(tm.sin(time) * 0.5, 0, 0)
+
+    dspAmp = .85
+    ro.xy += disp(ro.z) * dspAmp
+    tgtDst = 3.5
+
+    target = tm.normalize(ro - tm.vec3(disp(time + tgtDst) * dspAmp, time + tgtDst))
+    ro.x -= bsMo[None].x * 2
+    rightdir = tm.normalize(tm.cross(target, tm.vec3(0, 1, 0)))
+    updir = tm.normalize(tm.cross(rightdir, target))
+    rightdir = tm.normalize(tm.cross(updir, target))
+    roll = tm.rot2(disp(time + 3.5).x*0.2 - bsMo[None].x)
+    return Camera(ro=ro, rightdir=rightdir, updir=updir, target=target, roll=roll)
+
+
 @ti.kernel
-def step():
+def update_uniforms(prev_time: float):
+    bsMo[None] = (iMouse[None] - 0.5 * iResolution) / iResolution.y
+    prm1[None] = tm.smoothstep(-0.4, 0.4, tm.sin(iTime[None]*0.3))
+    cam[0] = camera(iTime[None] * 3)
+    cam[1] = camera(prev_time * 3)
+
+
+@ti.func
+def ray(i, j, c: ti.template()):
+    p = (tm.vec2(i, j) - 0.5 * iResolution) / iResolution.y
+    rd = tm.normalize((p.x * c.rightdir + p.y * c.updir) - c.target)
+    rd.xy = c.roll @ rd.xy
+    return rd
+
+
+@ti.func
+def shade(i, j):
+    q = tm.vec2(i, j) / iResolution
+    time = iTime[None] * 3
+    scn, dpt, calls = render(cam[0].ro, ray(i, j, cam[0]), time)
+    if ti.static(step_stats):
+        map_calls[i, j] += calls
+        shaded[i, j] += 1
+
+    col = scn.rgb
+    col = iLerp(col.bgr, col.rgb, tm.clamp(1 - prm1[None], 0.05, 1))
+    col = tm.pow(col, tm.vec3(.55, 0.65, 0.6)) * tm.vec3(1, 0.97, 0.9)
+    col *= tm.pow(16.0 * q.x * q.y * (1 - q.x) * (1 - q.y), 0.12) * 0.7 + 0.3
+    return col, dpt
+
+
+@ti.func
+def reproject(i, j, dpt):
+    # the pixel of the previous frame that saw the point at depth `dpt`
+    # along the ray of pixel (i, j)
+    x = cam[0].ro + ray(i, j, cam[0]) * dpt
+    d = x - cam[1].ro
+    d.xy = cam[1].roll.transpose() @ d.xy
+    k = max(-tm.dot(d, cam[1].target), 1e-6)
+    p = tm.vec2(tm.dot(d, cam[1].rightdir), tm.dot(d, cam[1].updir)) / k
+    return p * iResolution.y + 0.5 * iResolution
+
+
+@ti.kernel
+def render_image():
     for i, j in img:
-        fragCoord = tm.vec2(i, j)
-        q = fragCoord / iResolution
-        p = (fragCoord - 0.5 * iResolution) / iResolution.y
-        bsMo[None] = (iMouse[None] - 0.5 * iResolution) / iResolution.y
-
-        time = iTime[None] * 3
-        ro = tm.vec3(0, 0, time)
-        ro += tm.vec3(tm.sin(time) * 0.5, 0, 0)
-
-        dspAmp = .85
-        ro.xy += disp(ro.z) * dspAmp
-        tgtDst = 3.5
-
-        target = tm.normalize(ro - tm.vec3(disp(time + tgtDst) * dspAmp, time + tgtDst))
-        ro.x -= bsMo[None].x * 2
-        rightdir = tm.normalize(tm.cross(target, tm.vec3(0, 1, 0)))
-        updir = tm.normalize(tm.cross(rightdir, target))
-        rightdir = tm.normalize(tm.cross(updir, target))
-        rd = tm.normalize((p.x * rightdir + p.y * updir) - target)
-        rd.xy = tm.rot2(disp(time + 3.5).x*0.2 - bsMo[None].x) @ rd.xy
-        prm1[None] = tm.smoothstep(-0.4, 0.4, tm.sin(iTime[None]*0.3))
-        scn = render(ro, rd, time)
-
-        col = scn.rgb
-        col = iLerp(col.bgr, col.rgb, tm.clamp(1 - prm1[None], 0.05, 1))
-        col = tm.pow(col, tm.vec3(.55, 0.65, 0.6)) * tm.vec3(1, 0.97, 0.9)
-        col *= tm.pow(16.0 * q.x * q.y * (1 - q.x) * (1 - q.y), 0.12) * 0.7 + 0.3
-        img[i, j] = col
+        recorder.store(img, i, j, shade(i, j)[0])
+
+
+@ti.kernel
+def render_temporal(frame: int, full: int):
+    for i, j in img:
+        if full or temporal.rendered(i, j, frame, temporal_factor):
+            current[i, j], depth[i, j] = shade(i, j)
+
+    for i, j in img:
+        if not (full or temporal.rendered(i, j, frame, temporal_factor)):
+            dpt = temporal.neighbourhood(depth, i, j, frame, temporal_factor)[2]
+            temporal.resolve(current, history, i, j, reproject(i, j, dpt), frame, temporal_factor)
+
+    for i, j in img:
+        history[i, j] = current[i, j]
+        recorder.store(img, i, j, current[i, j])
+
+
+def step():
+    """Render one frame, in temporal mode only a part of the pixels is
+    rendered unless iMouse changed or the time went backwards.
+    """
+    global frame, last
+    if temporal_factor == 1:
+        update_uniforms(iTime[None])
+        if skip:
+            build_grid()
+        render_image()
+        return
+    now = (iTime[None], tuple(iMouse[None]))
+    full = last is None or now[1] != last[1] or now[0] < last[0]
+    update_uniforms(now[0] if full else last[0])
+    if skip:
+        build_grid()
+    render_temporal(frame, full)
+    last = now
+    frame += 1
+
+
+def render_offline():
+    init()
+
+    def advance(t):
+        iTime[None] = t
+        gov(step)
+
+    headless.run(args, 'protean_clouds', advance, img)
+    gov.report()
+    if step_stats:
+        print(f'{map_calls.to_numpy().sum() / max(shaded.to_numpy().sum(), 1):.1f} '
+              'map() calls per shaded pixel')
 
 
 def main():
     t0 = init()
     gui = ti.ui.Window('Protean Clouds', res=(W, H))
     canvas = gui.get_canvas()
+    rec = None
     while gui.running:
-        gui.get_event(ti.ui.PRESS)
+        if gui.get_event(ti.ui.PRESS) and gui.event.key == 'p':
+            rec = recorder.toggle(rec, args, 'protean_clouds')
         if gui.is_pressed(ti.ui.LMB):
             mouse_x, mouse_y = gui.get_cursor_pos()
             iMouse[None] = tm.vec2(mouse_x, mouse_y) * iResolution
@@ -162,15 +344,19 @@ def main():
         if gui.is_pressed(ti.ui.ESCAPE):
             gui.running = False
 
-        if gui.is_pressed('p'):
-            canvas.set_image(img)
-            gui.show('screenshot.png')
-
-        step()
+        gov(step)
+        if rec is not None:
+            rec.push(img)
         iTime[None] = time.perf_counter() - t0
         canvas.set_image(img)
         gui.show()
 
+    if rec is not None:
+        rec.close()
+
 
 if __name__ == '__main__':
-    main()
+    if args.headless:
+        render_offline()
+    else:
+        main()
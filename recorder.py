@@ -0,0 +1,163 @@
+"""
+Frame export shared by the demos.
+
+A `Recorder` reads a frame back from the device in the render loop and
+hands it to a writer thread through a bounded queue, so that the next
+frames are rendered while earlier ones are still being encoded. With
+`queue_size` 2 one frame is encoded while the next one waits, when the
+writer falls behind `push` blocks instead of buffering without limit.
+
+    with recorder.Recorder('frames', 'star_nest', 'png') as rec:
+        for frame in range(60):
+            step()
+            rec.push(img)
+
+writes `frames/star_nest_00000.png` and so on, with format 'y4m' the frames
+are appended to the raw YUV 4:4:4 stream `frames/star_nest.y4m` instead,
+which e.g. `ffmpeg -i star_nest.y4m star_nest.mp4` encodes.
+
+With `packed` the framebuffer of a demo made by `image` holds 8 bit RGBA,
+4 bytes per pixel like a packed u32, instead of float colors. The final
+kernel quantizes its colors with `store`, so the readback here, the export
+and `canvas.set_image` move a quarter of the data.
+"""
+import os
+import queue
+import threading
+import time
+from fractions import Fraction
+import numpy as np
+import taichi as ti
+import taichi.math as tm
+from PIL import Image
+
+FORMATS = ('png', 'y4m')
+
+
+def frame_rate(dt):
+    """The Y4M frame rate `num:den` of frames `dt` seconds apart.
+    """
+    if dt <= 0:
+        raise ValueError(f'a video needs a positive time step between frames, got {dt}')
+    rate = Fraction(1 / dt).limit_denominator(1001)
+    return f'{rate.numerator}:{rate.denominator}'
+
+
+def image(res, channels, packed):
+    """The framebuffer of a demo, `channels` floats or with `packed` 8 bit
+    RGBA per pixel.
+    """
+    if packed:
+        return ti.Vector.field(4, ti.u8, shape=res)
+    return ti.Vector.field(channels, float, shape=res)
+
+
+@ti.func
+def encode(img: ti.template(), color):
+    """`color` as stored in a framebuffer made by `image`, rounded as
+    `ti.tools.imwrite` does if it is packed.
+    """
+    if ti.static(img.dtype == ti.u8):
+        rgb = tm.clamp(tm.vec3(color[0], color[1], color[2]), 0, 1) * 255 + 0.5
+        return ti.cast(tm.vec4(rgb, 255), ti.u8)
+    else:
+        return color
+
+
+@ti.func
+def store(img: ti.template(), i, j, color):
+    """Write `color` to pixel (i, j) of a framebuffer made by `image`.
+    """
+    img[i, j] = encode(img, color)
+
+
+def to_bytes(frame):
+    """Convert the rgb(a) texels of a field of shape (W, H) to 8 bit rows
+    from top to bottom, as `ti.tools.imwrite` stores them.
+    """
+    if frame.dtype != np.uint8:
+        frame = (np.clip(frame[..., :3], 0, 1) * 255.0 + 0.5).astype(np.uint8)
+    return np.ascontiguousarray(frame[..., :3].swapaxes(0, 1)[::-1])
+
+
+class Recorder:
+    def __init__(self, outdir, name, fmt='png', dt=1 / 60, queue_size=2):
+        if fmt not in FORMATS:
+            raise ValueError(f'unknown format {fmt!r}, expected one of {FORMATS}')
+        os.makedirs(outdir, exist_ok=True)
+        self.outdir = outdir
+        self.name = name
+        self.fmt = fmt
+        self.dt = dt
+        self.frames = 0
+        self.stream = None
+        self.error = None
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.thread = threading.Thread(target=self.write_frames, daemon=True)
+        self.thread.start()
+
+    def push(self, img):
+        """Read the field `img` back, unless it is an array already, and
+        queue it as the next frame.
+        """
+        if self.error is not None:
+            raise self.error
+        self.queue.put(img if isinstance(img, np.ndarray) else img.to_numpy())
+        self.frames += 1
+
+    def close(self):
+        """Wait until all queued frames are written.
+        """
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write_frames(self):
+        index = 0
+        try:
+            while (frame := self.queue.get()) is not None:
+                if self.error is None:
+                    self.write(index, to_bytes(frame))
+                index += 1
+        except Exception as e:
+            # keep draining the queue so that `push` does not block forever
+            self.error = e
+            while self.queue.get() is not None:
+                pass
+        finally:
+            if self.stream is not None:
+                self.stream.close()
+
+    def write(self, index, rgb):
+        if self.fmt == 'png':
+            path = os.path.join(self.outdir, f'{self.name}_{index:05d}.png')
+            Image.fromarray(rgb).save(path, compress_level=1)
+            return
+        if self.stream is None:
+            h, w = rgb.shape[:2]
+            self.stream = open(os.path.join(self.outdir, f'{self.name}.y4m'), 'wb')
+            self.stream.write(f'YUV4MPEG2 W{w} H{h} F{frame_rate(self.dt)} Ip A1:1 C444 XCOLORRANGE=FULL\n'.encode())
+        ycbcr = np.asarray(Image.fromarray(rgb).convert('YCbCr'))
+        self.stream.write(b'FRAME\n')
+        self.stream.write(np.ascontiguousarray(ycbcr.transpose(2, 0, 1)).tobytes())
+
+
+def toggle(rec, args, name):
+    """Start a recording to `args.outdir` if `rec` is None and stop `rec`
+    otherwise, return the running recording or None.
+    """
+    if rec is None:
+        name = f'{name}_{time.strftime("%Y%m%d_%H%M%S")}'
+        print(f'recording {name} to {args.outdir}')
+        return Recorder(args.outdir, name, args.format, args.dt, args.queue)
+    rec.close()
+    print(f'recorded {rec.frames} frames')
+    return None
@@ -7,20 +7,69 @@ License Creative Commons Attribution-NonCommercial-ShareAlike 3.0 Unported Licen
 import time
 import taichi as ti
 import taichi.math as tm
-
-ti.init(arch=ti.vulkan)
-
-W, H = 800, 640
+import governor
+import headless
+import recorder
+import texture
+import tiles
+
+args = headless.parse_args('Seascape', res=(800, 640), aa=3, adaptive_aa=False,
+                           aa_threshold=0.08, aa_normal=0.5,
+                           bake=False, bake_res=2048, bake_extent=128.0, bake_near=16.0,
+                           target_fps=0.0, packed=False, tile=0, tile_worker='0/1')
+ti.init(arch=ti.cpu if args.headless else ti.vulkan)
+
+W, H = args.res
 iResolution = tm.vec2(W, H)
 iTime = ti.field(float, shape=())
 iMouse = ti.Vector.field(2, float, shape=())
 
-img = ti.Vector.field(3, float, shape=(W, H))
+# Tiled mode renders the still at iTime 0 in tiles of TW x TH pixels, the
+# pixel (i, j) of the framebuffers is the pixel (i, j) + origin of the
+# image, see tiles.py.
+tiled = args.tile > 0 and args.headless
+TW, TH = (args.tile, args.tile) if tiled else (W, H)
+origin = ti.Vector.field(2, int, shape=())
+
+img = recorder.image((TW, TH), 3, args.packed)
+
+# Per frame uniforms written by update_uniforms: the camera origin and
+# orientation.
+cam_pos = ti.Vector.field(3, float, shape=())
+cam_rot = ti.Matrix.field(3, 3, float, shape=())
 
 NUM_STEPS = 8
 EPSILON = 1e-3
 EPSILON_NRM = 0.1 / W
-AA = 1
+AA = args.aa  # samples per pixel are at most AA x AA
+
+# Adaptive anti-aliasing renders one sample per pixel first and takes the
+# AA x AA samples only where the tone mapped luminance differs from a
+# neighbour by more than aa_threshold or the normals by more than the
+# angle whose cosine is aa_normal.
+adaptive_aa = args.adaptive_aa
+aa_threshold = args.aa_threshold
+aa_normal = args.aa_normal
+# in tiled mode the base samples extend by kApron pixels around the tile
+kApron = 1 if tiled else 0
+base_res = (TW + 2 * kApron, TH + 2 * kApron) if adaptive_aa else 1
+base = ti.Vector.field(3, float, shape=base_res)
+base_normal = ti.Vector.field(3, float, shape=base_res)
+refined = ti.field(int, shape=())  # pixels supersampled in the last frame
+
+# Baked sea: every frame the heights of map and map_detailed and the
+# gradient of the latter are stored in a bake_res^2 texture covering
+# bake_extent units around the camera in every direction. Tracing samples
+# the texture wherever it is covered, shading only farther than bake_near
+# from the camera, the detailed octaves are finer than a texel. Elsewhere
+# the sea is evaluated analytically.
+bake = args.bake
+bake_res = args.bake_res
+bake_extent = args.bake_extent
+bake_near = args.bake_near
+bake_texel = 2 * bake_extent / bake_res
+sea_bake = ti.Vector.field(4, float, shape=(bake_res, bake_res) if bake else (1, 1))
+bake_center = ti.Vector.field(2, float, shape=())
 
 ITER_GEOMETRY = 3
 ITER_FRAGMENT = 5
@@ -32,6 +81,14 @@ SEA_BASE = tm.vec3(0.0, 0.09, 0.18)
 SEA_WATER_COLOR = tm.vec3(0.8, 0.9, 0.6) * 0.6
 octave_m = tm.mat2([[1.6, -1.2], [1.2, 1.6]])
 
+# the loop budgets, at most NUM_STEPS and ITER_FRAGMENT
+num_steps_budget = ti.field(int, shape=())
+octaves_budget = ti.field(int, shape=())
+gov = governor.Governor(args.target_fps, {
+    'NUM_STEPS': (num_steps_budget, 3, NUM_STEPS),
+    'ITER_FRAGMENT': (octaves_budget, ITER_GEOMETRY, ITER_FRAGMENT),
+})
+
 
 
 def init():
@@ -115,46 +172,65 @@ def seatime():
 
 
 @ti.func
-def map(p):
+def sea_heights(xz, iterations: ti.template()):
+    # the heights after ITER_GEOMETRY and after `iterations` octaves, the
+    # octaves past ITER_GEOMETRY are cut to the budget
     time = seatime()
     freq = SEA_FREQ
     amp = SEA_HEIGHT
     choppy = SEA_CHOPPY
-    uv = p.xz
+    uv = xz
     uv.x *= 0.75
 
-    d = h = 0.0
-    for i in range(ITER_GEOMETRY):
-        d = sea_octave((uv + time) * freq, choppy)
-        d += sea_octave((uv - time) * freq, choppy)
-        h += d * amp
-        uv = octave_m @ uv
-        freq *= 1.9
-        amp *= 0.22
-        choppy = tm.mix(choppy, 1.0, 0.2)
+    d = h = h_geometry = 0.0
+    for i in ti.static(range(iterations)):
+        active = True
+        if ti.static(i >= ITER_GEOMETRY):
+            active = i < octaves_budget[None]
+        if active:
+            d = sea_octave((uv + time) * freq, choppy)
+            d += sea_octave((uv - time) * freq, choppy)
+            h += d * amp
+            uv = octave_m @ uv
+            freq *= 1.9
+            amp *= 0.22
+            choppy = tm.mix(choppy, 1.0, 0.2)
+        if ti.static(i == ITER_GEOMETRY - 1):
+            h_geometry = h
+    return h_geometry, h
 
-    return p.y - h
+
+@ti.func
+def baked(p, near):
+    inside = False
+    if ti.static(bake):
+        d = p.xz - bake_center[None]
+        inside = tm.length(d) > near and max(abs(d.x), abs(d.y)) < bake_extent - bake_texel
+    return inside
 
 
 @ti.func
-def map_detailed(p):
-    time = seatime()
-    freq = SEA_FREQ
-    amp = SEA_HEIGHT
-    choppy = SEA_CHOPPY
-    uv = p.xz
-    uv.x *= 0.75
+def sample_bake(p):
+    return texture.sample(sea_bake, (p.xz - bake_center[None] + bake_extent) / (2 * bake_extent), False)
 
-    d = h = 0.0
-    for i in range(ITER_FRAGMENT):
-        d = sea_octave((uv + time) * freq, choppy)
-        d += sea_octave((uv - time) * freq, choppy)
-        h += d * amp
-        uv = octave_m @ uv
-        freq *= 1.9
-        amp *= 0.22
-        choppy = tm.mix(choppy, 1.0, 0.2)
 
+@ti.func
+def map(p):
+    h = 0.0
+    if baked(p, 0.0):
+        h = sample_bake(p).x
+    else:
+        h = sea_heights(p.xz, ITER_GEOMETRY)[1]
+    return p.y - h
+
+
+@ti.func
+def map_detailed(p):
+    h = 0.0
+    if baked(p, bake_near):
+        h = sample_bake(p).y
+    else:
+        h = sea_heights(p.xz, ITER_FRAGMENT)[1]
     return p.y - h
 
 
@@ -174,10 +250,15 @@ def getSeaColor(p, n, l, eye, dist):
 @ti.func
 def getNormal(p, eps):
     n = tm.vec3(0)
-    n.y = map_detailed(p)
-    n.x = map_detailed(tm.vec3(p.x + eps, p.y, p.z)) - n.y
-    n.z = map_detailed(tm.vec3(p.x, p.y, p.z + eps)) - n.y
-    n.y = eps
+    if baked(p, bake_near) and eps < bake_texel:
+        # finer than the texture, use the baked gradient
+        g = sample_bake(p).zw
+        n = tm.vec3(-g.x, 1, -g.y)
+    else:
+        n.y = map_detailed(p)
+        n.x = map_detailed(tm.vec3(p.x + eps, p.y, p.z)) - n.y
+        n.z = map_detailed(tm.vec3(p.x, p.y, p.z + eps)) - n.y
+        n.y = eps
     return tm.normalize(n)
 
 
@@ -193,7 +274,7 @@ def heightMapTracing(ro, rd):
     else:
         hmin = map(ro + rd * tmin)
         tmid = 0.0
-        for i in range(NUM_STEPS):
+        for i in range(num_steps_budget[None]):
             tmid = tm.mix(tmin, tmax, hmin / (hmin - hmax))
             p = ro + rd * tmid
             hmid = map(p)
@@ -206,48 +287,156 @@ def heightMapTracing(ro, rd):
     return p
 
 
+@ti.kernel
+def update_uniforms():
+    time = iTime[None] * 0.3 + iMouse[None].x * 0.01
+    ang = tm.vec3(tm.sin(time * 3) * 0.1, tm.sin(time) * 0.2 + 0.3, time)
+    ro = tm.vec3(0.0, 3.5, time * 5.0)
+    cam_pos[None] = ro
+    cam_rot[None] = fromEuler(ang)
+    bake_center[None] = ro.xz
+
+
 @ti.func
-def getPixel(coord, time):
+def getPixel(coord):
     uv = 2 * coord / iResolution - 1.0
     uv.x *= W / H
-    ang = tm.vec3(tm.sin(time * 3) * 0.1, tm.sin(time) * 0.2 + 0.3, time)
-    ro = tm.vec3(0.0, 3.5, time * 5.0)
+    ro = cam_pos[None]
     rd = tm.normalize(tm.vec3(uv.xy, -2.0))
     rd.z += tm.length(uv) * 0.14
-    rd = fromEuler(ang) @ tm.normalize(rd)
+    rd = cam_rot[None] @ tm.normalize(rd)
 
     p = heightMapTracing(ro, rd)
     dist = p - ro
     n = getNormal(p, tm.dot(dist, dist) * EPSILON_NRM)
     light = tm.normalize(tm.vec3(0.0, 1.0, 0.8))
 
-    return tm.mix(
+    color = tm.mix(
         getSkyColor(rd),
         getSeaColor(p, n, light, rd, dist),
         tm.pow(tm.smoothstep(0, -0.02, rd.y), 0.2)
     )
+    return color, n
 
 
 @ti.kernel
-def step():
-    time = iTime[None] * 0.3 + iMouse[None].x * 0.01
-    for i, j in img:
-        color = tm.vec3(0)
-        for dx, dy in ti.ndrange((-1, 2), (-1, 2)):
-            uv = tm.vec2(i, j) + tm.vec2(dx, dy) / 3
-            color += getPixel(uv, time)
+def bake_heights():
+    for i, j in sea_bake:
+        xz = bake_center[None] - bake_extent + (tm.vec2(i, j) + 0.5) * bake_texel
+        sea_bake[i, j].xy = sea_heights(xz, ITER_FRAGMENT)
+
+
+@ti.kernel
+def bake_gradient():
+    for i, j in sea_bake:
+        i0, i1 = max(i - 1, 0), min(i + 1, bake_res - 1)
+        j0, j1 = max(j - 1, 0), min(j + 1, bake_res - 1)
+        sea_bake[i, j].z = (sea_bake[i1, j].y - sea_bake[i0, j].y) / ((i1 - i0) * bake_texel)
+        sea_bake[i, j].w = (sea_bake[i, j1].y - sea_bake[i, j0].y) / ((j1 - j0) * bake_texel)
+
+
+@ti.func
+def pixel(i, j):
+    # the image coordinates of pixel (i, j) of the framebuffers, formed in
+    # integers, fast math would otherwise reassociate the offset
+    p = tm.vec2(i, j)
+    if ti.static(tiled):
+        p = float(tm.ivec2(i, j) + origin[None])
+    return p
+
 
-        color /= 9.0
+@ti.func
+def supersample(i, j):
+    color = tm.vec3(0)
+    for dx, dy in ti.ndrange(AA, AA):
+        uv = pixel(i, j) + (tm.vec2(dx, dy) - (AA - 1) / 2) / AA
+        color += getPixel(uv)[0]
+    return color / (AA * AA)
+
+
+@ti.kernel
+def render():
+    for i, j in img:
+        color = supersample(i, j)
         color = tm.pow(color, 0.65)
-        img[i, j] = color
+        recorder.store(img, i, j, color)
+
+
+@ti.kernel
+def render_base():
+    for i, j in base:
+        base[i, j], base_normal[i, j] = getPixel(pixel(i - kApron, j - kApron))
+
+
+@ti.func
+def luminance(color):
+    return tm.dot(tm.pow(color, 0.65), tm.vec3(0.299, 0.587, 0.114))
+
+
+@ti.kernel
+def render_refined():
+    refined[None] = 0
+    for i, j in img:
+        c = tm.ivec2(i, j) + kApron
+        lum = luminance(base[c])
+        edge = False
+        for k in ti.static(range(4)):
+            q = tm.clamp(tm.ivec2(i, j) + origin[None] + ti.static([(1, 0), (-1, 0), (0, 1), (0, -1)][k]),
+                         0, tm.ivec2(W - 1, H - 1)) - origin[None] + kApron
+            if abs(luminance(base[q]) - lum) > aa_threshold or \
+                    tm.dot(base_normal[q], base_normal[c]) < aa_normal:
+                edge = True
+        color = base[c]
+        if edge:
+            color = supersample(i, j)
+            refined[None] += 1
+        recorder.store(img, i, j, tm.pow(color, 0.65))
+
+
+def render_pixels():
+    if adaptive_aa:
+        render_base()
+        render_refined()
+    else:
+        render()
+
+
+def step():
+    update_uniforms()
+    if bake:
+        bake_heights()
+        bake_gradient()
+    render_pixels()
+
+
+def render_offline():
+    init()
+    if tiled:
+        update_uniforms()
+        if bake:
+            bake_heights()
+            bake_gradient()
+        tiles.render(args, 'seascape', origin, render_pixels, img)
+        return
+
+    def advance(t):
+        iTime[None] = t
+        gov(step)
+
+    headless.run(args, 'seascape', advance, img)
+    gov.report()
+    if adaptive_aa:
+        print(f'{refined[None] / (W * H):.1%} of the pixels supersampled in the last frame')
 
 
 def main():
     t0 = init()
     gui = ti.ui.Window('Seascape', res=(W, H))
     canvas = gui.get_canvas()
+    rec = None
     while gui.running:
-        gui.get_event(ti.ui.PRESS)
+        if gui.get_event(ti.ui.PRESS) and gui.event.key == 'p':
+            rec = recorder.toggle(rec, args, 'seascape')
         if gui.is_pressed(ti.ui.LMB):
             mouse_x, mouse_y = gui.get_cursor_pos()
             iMouse[None] = tm.vec2(mouse_x, mouse_y) * iResolution
@@ -255,15 +444,19 @@ def main():
         if gui.is_pressed(ti.ui.ESCAPE):
             gui.running = False
 
-        if gui.is_pressed('p'):
-            canvas.set_image(img)
-            gui.show('screenshot.png')
-
-        step()
+        gov(step)
+        if rec is not None:
+            rec.push(img)
         iTime[None] = time.perf_counter() - t0
         canvas.set_image(img)
         gui.show()
 
+    if rec is not None:
+        rec.close()
+
 
 if __name__ == '__main__':
-    main()
+    if args.headless:
+        render_offline()
+    else:
+        main()
@@ -2,15 +2,30 @@
 import time
 import taichi as ti
 import taichi.math as tm
+import governor
+import headless
+import recorder
+import temporal
 
-ti.init(arch=ti.vulkan)
+args = headless.parse_args('Star Nest', res=(800, 640), temporal=1, target_fps=0.0,
+                           packed=False, batch=0)
+ti.init(arch=ti.cpu if args.headless else ti.vulkan)
 
-W, H = 800, 640
+W, H = args.res
 iResolution = tm.vec2(W, H)
 iTime = ti.field(float, shape=())
 iMouse = ti.Vector.field(2, float, shape=())
 
-img = ti.Vector.field(3, float, shape=(W, H))
+img = recorder.image((W, H), 3, args.packed)
+
+# frames rendered by one launch of render_batch, which ignores --temporal
+batch, frame_time, frames = headless.batch_fields(args, 3)
+
+# Per frame uniforms written by update_uniforms, for each frame of a batch:
+# the rotations of the view and the origin of the rays.
+R1 = ti.Matrix.field(2, 2, float, shape=frame_time.shape)
+R2 = ti.Matrix.field(2, 2, float, shape=frame_time.shape)
+origin = ti.Vector.field(3, float, shape=frame_time.shape)
 
 iterations = 17
 formuparam = 0.53
@@ -27,6 +42,25 @@ darkmatter = 0.300
 distfading = 0.730
 saturation = 0.850
 
+# the loop budgets, at most volsteps and iterations
+volsteps_budget = ti.field(int, shape=())
+iterations_budget = ti.field(int, shape=())
+gov = governor.Governor(args.target_fps, {
+    'volsteps': (volsteps_budget, 8, volsteps),
+    'iterations': (iterations_budget, 8, iterations),
+})
+
+# Temporal mode renders 1 / temporal_factor of the pixels per frame, see
+# temporal.py. The camera moves along (2, 1, 0) in its own frame, pixels
+# are reprojected as if their color came from the depth s = kReprojectDepth.
+temporal_factor = args.temporal
+kReprojectDepth = 1.0
+history = ti.Vector.field(3, float, shape=(W, H) if temporal_factor > 1 else (1, 1))
+# the colors of the frame being resolved, `img` itself unless it is packed
+current = ti.Vector.field(3, float, shape=(W, H)) if args.packed and temporal_factor > 1 else img
+frame = 0
+last = None  # iTime and iMouse of the previous frame
+
 
 def init():
     iTime[None] = 0.0
@@ -34,56 +68,130 @@ def init():
     return time.perf_counter()
 
 
+@ti.func
+def set_uniforms(f, t):
+    time = t * speed + 0.25
+    a1 = 0.5 + iMouse[None].x * 2
+    a2 = 0.8 + iMouse[None].y * 2
+    r1 = tm.rot2(-a1)
+    r2 = tm.rot2(-a2)
+    fr = tm.vec3(1, 0.5, 0.5)
+    fr += tm.vec3(2*time, time, -2)
+    fr.xz = r1 @ fr.xz
+    fr.xy = r2 @ fr.xy
+    R1[f] = r1
+    R2[f] = r2
+    origin[f] = fr
+
+
 @ti.kernel
-def step():
+def update_uniforms():
+    set_uniforms(0, iTime[None])
+
+
+@ti.func
+def shade(i, j, f):
+    uv = tm.vec2(i, j) / iResolution - 0.5
+    uv.y *= H / W
+    dir = tm.vec3(uv * zoom, 1)
+    dir.xz = R1[f] @ dir.xz
+    dir.xy = R2[f] @ dir.xy
+    fr = origin[f]
+
+    s, fade = 0.1, 1.0
+    v = tm.vec3(0)
+    for r in range(volsteps_budget[None]):
+        p = fr + s * dir * 0.5
+        p = abs(tm.vec3(tile) - tm.mod(p, tm.vec3(tile * 2)))
+        pa = a = 0.0
+        for _ in range(iterations_budget[None]):
+            p = abs(p) / tm.dot(p, p) - formuparam
+            a += abs(tm.length(p) - pa)
+            pa = tm.length(p)
+
+        dm = max(0, darkmatter - a * a * 0.001)
+        a *= a*a
+        if r > 6:
+            fade *= 1 - dm
+
+        v += fade
+        v += tm.vec3(s, s*s, s*s*s*s) * a * fade * brightness
+        fade *= distfading
+        s += stepsize
+
+    color = tm.mix(tm.vec3(tm.length(v)), v, saturation)
+    return color * 0.01
+
+
+@ti.kernel
+def render_image():
     for i, j in img:
-        uv = tm.vec2(i, j) / iResolution - 0.5
-        uv.y *= H / W
-        dir = tm.vec3(uv * zoom, 1)
-        time = iTime[None] * speed + 0.25
-
-        a1 = 0.5 + iMouse[None].x * 2
-        a2 = 0.8 + iMouse[None].y * 2
-        R1 = tm.rot2(-a1)
-        R2 = tm.rot2(-a2)
-        dir.xz = R1 @ dir.xz
-        dir.xy = R2 @ dir.xy
-        fr = tm.vec3(1, 0.5, 0.5)
-        fr += tm.vec3(2*time, time, -2)
-        fr.xz = R1 @ fr.xz
-        fr.xy = R2 @ fr.xy
-
-        s, fade = 0.1, 1.0
-        v = tm.vec3(0)
-        for r in range(volsteps):
-            p = fr + s * dir * 0.5
-            p = abs(tm.vec3(tile) - tm.mod(p, tm.vec3(tile * 2)))
-            pa = a = 0.0
-            for _ in range(iterations):
-                p = abs(p) / tm.dot(p, p) - formuparam
-                a += abs(tm.length(p) - pa)
-                pa = tm.length(p)
-
-            dm = max(0, darkmatter - a * a * 0.001)
-            a *= a*a
-            if r > 6:
-                fade *= 1 - dm
-
-            v += fade
-            v += tm.vec3(s, s*s, s*s*s*s) * a * fade * brightness
-            fade *= distfading
-            s += stepsize
-
-        color = tm.mix(tm.vec3(tm.length(v)), v, saturation)
-        img[i, j] = color * 0.01
+        recorder.store(img, i, j, shade(i, j, 0))
+
+
+@ti.kernel
+def render_batch():
+    for f in frame_time:
+        set_uniforms(f, frame_time[f])
+    for f, i, j in frames:
+        frames[f, i, j] = recorder.encode(frames, shade(i, j, f))
+
+
+@ti.kernel
+def render_temporal(frame: int, dt: float, full: int):
+    for i, j in img:
+        if full or temporal.rendered(i, j, frame, temporal_factor):
+            current[i, j] = shade(i, j, 0)
+
+    # the pixel a point at depth kReprojectDepth moved by since the last frame
+    shift = tm.vec2(2, 1) * dt * speed / (0.5 * kReprojectDepth * zoom) * W
+    for i, j in img:
+        if not (full or temporal.rendered(i, j, frame, temporal_factor)):
+            temporal.resolve(current, history, i, j, tm.vec2(i, j) + shift, frame, temporal_factor)
+
+    for i, j in img:
+        history[i, j] = current[i, j]
+        recorder.store(img, i, j, current[i, j])
+
+
+def step():
+    """Render one frame, in temporal mode only a part of the pixels is
+    rendered unless iMouse changed or the time went backwards.
+    """
+    global frame, last
+    update_uniforms()
+    if temporal_factor == 1:
+        render_image()
+        return
+    now = (iTime[None], tuple(iMouse[None]))
+    full = last is None or now[1] != last[1] or now[0] < last[0]
+    render_temporal(frame, 0.0 if full else now[0] - last[0], full)
+    last = now
+    frame += 1
+
+
+def render_offline():
+    init()
+    if batch:
+        headless.run_batch(args, 'star_nest', render_batch, frame_time, frames)
+        return
+
+    def advance(t):
+        iTime[None] = t
+        gov(step)
+
+    headless.run(args, 'star_nest', advance, img)
+    gov.report()
 
 
 def main():
     t0 = init()
     gui = ti.ui.Window('Star Nest', res=(W, H))
     canvas = gui.get_canvas()
+    rec = None
     while gui.running:
-        gui.get_event(ti.ui.PRESS)
+        if gui.get_event(ti.ui.PRESS) and gui.event.key == 'p':
+            rec = recorder.toggle(rec, args, 'star_nest')
         if gui.is_pressed(ti.ui.LMB):
             mouse_x, mouse_y = gui.get_cursor_pos()
             iMouse[None] = tm.vec2(mouse_x, mouse_y) * iResolution
@@ -91,15 +199,19 @@ def main():
         if gui.is_pressed(ti.GUI.ESCAPE):
             gui.running = False
 
-        if gui.is_pressed('p'):
-            canvas.set_image(img)
-            gui.show('screenshot.png')
-
-        step()
+        gov(step)
+        if rec is not None:
+            rec.push(img)
         iTime[None] = time.perf_counter() - t0
         canvas.set_image(img)
         gui.show()
 
+    if rec is not None:
+        rec.close()
+
 
 if __name__ == '__main__':
-    main()
+    if args.headless:
+        render_offline()
+    else:
+        main()
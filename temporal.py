@@ -0,0 +1,60 @@
+"""
+Temporal rendering for the demos with expensive pixels.
+
+With a `factor` of 2 a frame renders one color of a checkerboard of pixels,
+with a factor of 4 one pixel of every 2x2 block, alternating between frames
+so that every pixel is rendered once in `factor` frames. The other pixels
+are reprojected: the demo maps each of them to its position in the
+previous frame, where the history is sampled bilinearly. The result is
+clamped to the range of the pixels rendered around it in this frame, so
+disocclusions and changing colors do not leave trails.
+"""
+import taichi as ti
+import taichi.math as tm
+import texture
+
+
+@ti.func
+def rendered(i, j, frame, factor: ti.template()):
+    """Whether pixel (i, j) is rendered in `frame`.
+    """
+    result = True
+    if ti.static(factor == 2):
+        result = (i + j + frame) % 2 == 0
+    elif ti.static(factor == 4):
+        # the blocks are visited in the order (0, 0), (1, 1), (1, 0), (0, 1)
+        k = frame % 4
+        result = i % 2 == int(k == 1 or k == 2) and j % 2 == int(k == 1 or k == 3)
+    return result
+
+
+@ti.func
+def neighbourhood(field: ti.template(), i, j, frame, factor: ti.template()):
+    """Minimum, maximum and mean of `field` over the pixels of the 3x3
+    neighbourhood of (i, j) that are rendered in `frame`.
+    """
+    lo = field[i, j] * 0 + 1e9
+    hi = -lo
+    total = lo * 0
+    n = 0
+    for di, dj in ti.static(ti.ndrange((-1, 2), (-1, 2))):
+        q = tm.ivec2(i + di, j + dj)
+        if 0 <= q.x < field.shape[0] and 0 <= q.y < field.shape[1] and rendered(q.x, q.y, frame, factor):
+            lo = min(lo, field[q])
+            hi = max(hi, field[q])
+            total += field[q]
+            n += 1
+    return lo, hi, total / max(n, 1)
+
+
+@ti.func
+def resolve(img: ti.template(), history: ti.template(), i, j, prev, frame, factor: ti.template()):
+    """Fill the pixel (i, j) that is not rendered in `frame` from the
+    previous frame `history` at pixel position `prev`.
+    """
+    lo, hi, mean = neighbourhood(img, i, j, frame, factor)
+    color = mean
+    res = tm.vec2(img.shape[0], img.shape[1])
+    if 0 <= prev.x <= res.x - 1 and 0 <= prev.y <= res.y - 1:
+        color = tm.clamp(texture.sample(history, (prev + 0.5) / res, False), lo, hi)
+    img[i, j] = color
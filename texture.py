@@ -0,0 +1,71 @@
+"""
+Image textures shared by the demos.
+
+`load` decodes an image once and keeps the decoded float32 RGBA texels in a
+`.npy` cache next to it, later starts memory map the cache instead of
+decoding the image again. The texels are laid out like a Taichi field of
+shape (W, H) with the origin at the bottom left, as `uv` is in a shader:
+
+    iChannel1 = ti.Vector.field(4, float, shape=(64, 64))
+    iChannel1.from_numpy(texture.load('noise_gray_64x64.png', (64, 64)))
+
+`sample` filters a field bilinearly with repeat or clamp addressing.
+"""
+import os
+import numpy as np
+import taichi as ti
+import taichi.math as tm
+from PIL import Image
+
+CACHE_DIR = '.texture_cache'
+
+
+def cache_path(image_file, res=None):
+    head, tail = os.path.split(os.path.abspath(image_file))
+    size = '' if res is None else f'.{res[0]}x{res[1]}'
+    return os.path.join(head, CACHE_DIR, tail + size + '.npy')
+
+
+def load(image_file, res=None):
+    """Return the texels of `image_file`, resized to `res` if given, as a
+    read only float32 array of shape (W, H, 4).
+    """
+    path = cache_path(image_file, res)
+    if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(image_file):
+        img = Image.open(image_file).convert('RGBA')
+        if res is not None:
+            img = img.resize(tuple(res))
+        data = np.asarray(img, np.float32) / 255.0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # a private name, several processes may fill the cache at once
+        tmp = f'{path}.{os.getpid()}.tmp.npy'
+        np.save(tmp, np.ascontiguousarray(data.swapaxes(0, 1)[:, ::-1]))
+        os.replace(tmp, path)
+    return np.load(path, mmap_mode='r')
+
+
+@ti.func
+def texel(tex: ti.template(), ij, repeat: ti.template()):
+    res = tm.ivec2(tex.shape[0], tex.shape[1])
+    if ti.static(repeat):
+        ij %= res
+    else:
+        ij = tm.clamp(ij, 0, res - 1)
+    return tex[ij]
+
+
+@ti.func
+def sample(tex: ti.template(), uv, repeat: ti.template()):
+    """Bilinear filtering of `tex` at `uv` with texel centers at half
+    integers, the texture repeats outside [0, 1) if `repeat` is true and is
+    clamped to its border otherwise.
+    """
+    p = uv * tm.vec2(tex.shape[0], tex.shape[1]) - 0.5
+    ip = tm.floor(p)
+    f = p - ip
+    ij = int(ip)
+    a = texel(tex, ij, repeat)
+    b = texel(tex, ij + tm.ivec2(1, 0), repeat)
+    c = texel(tex, ij + tm.ivec2(0, 1), repeat)
+    d = texel(tex, ij + tm.ivec2(1, 1), repeat)
+    return tm.mix(tm.mix(a, b, f.x), tm.mix(c, d, f.x), f.y)
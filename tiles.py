@@ -0,0 +1,71 @@
+"""
+Tiled rendering of stills larger than memory.
+
+A demo started with `--tile N` sizes its framebuffers to N x N pixels and
+adds the pixel offset of the current tile, the 0-d field `origin`, to the
+pixel coordinates in its kernels. `render` renders the tiles one after
+another and copies each into `{outdir}/{name}_{W}x{H}.npy`, a memory mapped
+uint8 array of shape (H, W, 3) with the top row first, so memory holds a
+tile and not the image:
+
+    python seascape.py --headless --res 15360 8640 --tile 1024
+
+Tiles are also the unit of work across processes: `--tile-worker I/N`
+renders every N-th tile starting at tile I into the same file, which the
+first worker to start creates.
+"""
+import os
+import time
+import numpy as np
+import recorder
+
+
+def offsets(res, tile):
+    """The pixel offsets of the tiles covering `res`, row by row.
+    """
+    return [(x, y) for y in range(0, res[1], tile) for x in range(0, res[0], tile)]
+
+
+def open_output(path, res):
+    """Memory map the image `path`, creating it if it does not exist yet.
+    """
+    shape = (res[1], res[0], 3)
+    if not os.path.exists(path):
+        # create under a private name and link it into place, of several
+        # workers starting at once only one creates the file
+        tmp = f'{path}.{os.getpid()}.tmp.npy'
+        np.lib.format.open_memmap(tmp, mode='w+', dtype=np.uint8, shape=shape).flush()
+        try:
+            os.link(tmp, path)
+        except FileExistsError:
+            pass
+        os.remove(tmp)
+    out = np.load(path, mmap_mode='r+')
+    if out.shape != shape:
+        raise ValueError(f'{path} has shape {out.shape}, expected {shape}')
+    return out
+
+
+def render(args, name, origin, render_tile, img):
+    """Render the tiles of this worker, `render_tile()` launches the kernels
+    of the tile at `origin` into the framebuffer `img`.
+    """
+    W, H = args.res
+    tile = args.tile
+    worker, workers = map(int, args.tile_worker.split('/'))
+    os.makedirs(args.outdir, exist_ok=True)
+    path = os.path.join(args.outdir, f'{name}_{W}x{H}.npy')
+    out = open_output(path, args.res)
+
+    t0 = time.perf_counter()
+    mine = offsets(args.res, tile)[worker::workers]
+    for k, (x, y) in enumerate(mine):
+        origin[None] = x, y
+        render_tile()
+        rgb = recorder.to_bytes(img.to_numpy())
+        # the rows of rgb run from the top of the tile down
+        w, h = min(tile, W - x), min(tile, H - y)
+        out[H - y - h:H - y, x:x + w] = rgb[tile - h:, :w]
+        print(f'tile {k + 1}/{len(mine)} at ({x}, {y}) done after {time.perf_counter() - t0:.1f}s')
+    out.flush()
+    print(f'{name}: {len(mine)} tiles of {tile}x{tile} in {time.perf_counter() - t0:.2f}s -> {path}')
@@ -0,0 +1,225 @@
+"""
+Quality of the fast paths of the demos against their reference renders.
+
+    python verify.py                                  # all demos
+    python verify.py seascape --res 400 320 --times 1 10
+    python verify.py --refdir verify_ref --update     # store new references
+
+Every variant of a demo, i.e. a set of its command line options, renders the
+frames at the animation times `--times` on `ti.cpu` in its own process, with
+iMouse at `--mouse` and a fixed random seed. The frames of the `reference`
+variant, the default options, are stored in `--refdir` on the first run and
+every variant is compared against them, reporting the PSNR and the SSIM of
+the frames next to the speedup over the reference. Variants below
+`--min-psnr` or `--min-ssim` are marked, and the run fails if the reference
+itself no longer matches the stored frames.
+"""
+import argparse
+import importlib
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import numpy as np
+
+# For every demo: the number of frames rendered up to each time, so that
+# temporal modes have a history, the function rendering one frame of
+# module `m` at time `t`, and the variants given as extra options.
+DEMOS = {
+    'star_nest': (4, lambda m, t: (m.iTime.fill(t), m.step()), {
+        'temporal2': ['--temporal', '2'],
+        'temporal4': ['--temporal', '4'],
+        'temporal4+packed': ['--temporal', '4', '--packed'],
+    }),
+    'seascape': (1, lambda m, t: (m.iTime.fill(t), m.step()), {
+        'aa1': ['--aa', '1'],
+        'adaptive_aa': ['--adaptive-aa'],
+        'bake': ['--bake'],
+        'packed': ['--packed'],
+        'adaptive_aa+bake': ['--adaptive-aa', '--bake'],
+    }),
+    'protean_clouds': (4, lambda m, t: (m.iTime.fill(t), m.step()), {
+        'skip': ['--skip'],
+        'packed': ['--packed'],
+        'temporal2': ['--temporal', '2'],
+        'temporal4': ['--temporal', '4'],
+    }),
+    'flame': (1, lambda m, t: (m.iTime.fill(t), m.step()), {
+        'packed': ['--packed'],
+    }),
+    'fractal_stamens': (1, lambda m, t: m.step(t), {
+        'early_exit': ['--early-exit'],
+        'packed': ['--packed'],
+    }),
+    # a frame is one sample per pixel, the image after all of them is
+    # compared, another seed gives the difference due to noise alone
+    'creative_block': (256, lambda m, t: (m.accumulate(), m.renderImage()), {
+        'seed1': ['--seed', '1'],
+        'wavefront': ['--wavefront'],
+        'adaptive': ['--adaptive'],
+        'relax': ['--relax', '1.6'],
+        'packed': ['--packed'],
+    }),
+    # the frames after the start of the simulation, with the image feedback
+    # of the renderer built up, against all pairs drawn for every pixel; the
+    # longer time step in DEMO_ARGS lets force errors show within 8 frames
+    'nbody': (8, lambda m, t: (m.iTime.fill(t), m.simulate(), m.draw()), {
+        'barnes_hut': ['--solver', 'barnes-hut'],
+        'pm': ['--solver', 'pm'],
+        'p3m': ['--solver', 'pm', '--p3m'],
+        'binned': ['--renderer', 'binned'],
+    }),
+}
+
+# Options every variant of a demo is run with.
+DEMO_ARGS = {
+    'creative_block': ['--seed', '0'],
+    'nbody': ['--solver', 'direct', '--renderer', 'direct', '--time-step', '6e-4'],
+}
+
+
+def psnr(a, b):
+    mse = np.mean((a - b) ** 2)
+    return float('inf') if mse == 0 else 10 * np.log10(1 / mse)
+
+
+def blur(x, sigma=1.5, radius=5):
+    """Separable gaussian filter of the first two axes of `x`, the border is
+    cropped as in the reference SSIM implementation.
+    """
+    w = np.exp(-0.5 * (np.arange(-radius, radius + 1) / sigma) ** 2)
+    w /= w.sum()
+    n = 2 * radius
+    x = sum(w[k] * x[k:x.shape[0] - n + k] for k in range(n + 1))
+    return sum(w[k] * x[:, k:x.shape[1] - n + k] for k in range(n + 1))
+
+
+def ssim(a, b):
+    """Mean structural similarity of two images with values in [0, 1], with
+    the constants of Wang et al. 2004, averaged over the color channels.
+    """
+    c1, c2 = 0.01 ** 2, 0.03 ** 2
+    mu_a, mu_b = blur(a), blur(b)
+    var_a = blur(a * a) - mu_a ** 2
+    var_b = blur(b * b) - mu_b ** 2
+    cov = blur(a * b) - mu_a * mu_b
+    s = ((2 * mu_a * mu_b + c1) * (2 * cov + c2)) / ((mu_a ** 2 + mu_b ** 2 + c1) * (var_a + var_b + c2))
+    return float(s.mean())
+
+
+def worker(demo, variant, res, times, mouse, out):
+    """Render the frames of one variant of `demo` in this process, store
+    them in the .npy file `out` and print the median ms per frame.
+    """
+    frames, render, variants = DEMOS[demo]
+    extra = [] if variant == 'reference' else variants[variant]
+    sys.argv = [demo, '--headless', '--res', str(res[0]), str(res[1])] + DEMO_ARGS.get(demo, []) + extra
+    module = importlib.import_module(demo)
+    import taichi as ti
+
+    dt = module.args.dt
+    images = []
+    durations = []
+    for t in times:
+        if hasattr(module, 'init'):
+            module.init()
+        if hasattr(module, 'iMouse'):
+            module.iMouse[None] = mouse
+        for k in range(frames):
+            t0 = time.perf_counter()
+            render(module, t - (frames - 1 - k) * dt)
+            ti.sync()
+            durations.append(time.perf_counter() - t0)
+        image = module.img.to_numpy()[..., :3]
+        if image.dtype == np.uint8:
+            image = image / 255.0
+        images.append(np.clip(np.nan_to_num(image), 0, 1))
+    np.save(out, np.stack(images))
+    # the first frame includes the compilation
+    print(json.dumps({'ms': statistics.median(durations[1:] or durations) * 1e3}))
+
+
+def run_worker(demo, variant, res, times, mouse, out):
+    cmd = [sys.executable, os.path.abspath(__file__), demo, '--worker', variant, '--out', out,
+           '--res', str(res[0]), str(res[1]), '--mouse', str(mouse[0]), str(mouse[1]),
+           '--times'] + [str(t) for t in times]
+    # headless demos run on ti.cpu, unless TI_ARCH overrides it
+    env = {k: v for k, v in os.environ.items() if k != 'TI_ARCH'}
+    out = subprocess.run(cmd, env=env, capture_output=True, text=True,
+                         cwd=os.path.dirname(os.path.abspath(__file__)))
+    if out.returncode != 0:
+        raise RuntimeError(f'{demo} {variant} failed:\n{out.stderr}')
+    return json.loads(out.stdout.strip().splitlines()[-1])['ms']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the fast paths of the demos against reference renders.')
+    parser.add_argument('demos', nargs='*', default=list(DEMOS), metavar='demo',
+                        help='demos to verify, default: all of ' + ', '.join(DEMOS))
+    parser.add_argument('--res', type=int, nargs=2, default=[320, 256], metavar=('W', 'H'))
+    parser.add_argument('--times', type=float, nargs='+', default=[1.0, 7.0],
+                        help='animation times of the compared frames')
+    parser.add_argument('--mouse', type=float, nargs=2, default=[0.0, 0.0], metavar=('X', 'Y'),
+                        help='iMouse of the compared frames')
+    parser.add_argument('--refdir', default='verify_ref',
+                        help='directory of the stored reference frames')
+    parser.add_argument('--update', action='store_true',
+                        help='replace the stored reference frames')
+    parser.add_argument('--min-psnr', type=float, default=30.0)
+    parser.add_argument('--min-ssim', type=float, default=0.95)
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    parser.add_argument('--out', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        worker(args.demos[0], args.worker, args.res, args.times, args.mouse, args.out)
+        return
+
+    unknown = set(args.demos) - set(DEMOS)
+    if unknown:
+        parser.error('unknown demos: ' + ', '.join(sorted(unknown)))
+
+    os.makedirs(args.refdir, exist_ok=True)
+    changed = []
+    print(f'{"variant":<40}{"ms":>10}{"speedup":>10}{"PSNR dB":>10}{"SSIM":>8}')
+    for demo in args.demos:
+        stem = os.path.join(args.refdir, f'{demo}_{args.res[0]}x{args.res[1]}')
+        ref_path = stem + '.npy'
+        ref_meta = stem + '.json'
+        meta = {'times': args.times, 'mouse': args.mouse}
+        if not args.update and os.path.exists(ref_meta):
+            with open(ref_meta) as f:
+                if json.load(f) != meta:
+                    parser.error(f'{ref_path} was rendered with other --times or --mouse, use --update')
+
+        ref_ms = None
+        for variant in ['reference'] + list(DEMOS[demo][2]):
+            out = stem + f'.{variant}.tmp.npy'
+            ms = run_worker(demo, variant, args.res, args.times, args.mouse, out)
+            if variant == 'reference':
+                ref_ms = ms
+                if args.update or not os.path.exists(ref_path):
+                    os.replace(out, ref_path)
+                    with open(ref_meta, 'w') as f:
+                        json.dump(meta, f)
+            images = np.load(out if os.path.exists(out) else ref_path)
+            if os.path.exists(out):
+                os.remove(out)
+            ref = np.load(ref_path)
+            p = min(psnr(a, b) for a, b in zip(images, ref))
+            s = min(ssim(a, b) for a, b in zip(images, ref))
+            accepted = p >= args.min_psnr and s >= args.min_ssim
+            if variant == 'reference' and not accepted:
+                changed.append(demo)
+            print(f'{demo + "." + variant:<40}{ms:>10.1f}{ref_ms / ms:>9.2f}x{p:>10.1f}{s:>8.3f}'
+                  + ('' if accepted else '  REJECT'))
+
+    if changed:
+        print('the reference of ' + ', '.join(changed) + f' no longer matches {args.refdir}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()